@@ -0,0 +1,49 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from aiogram.types import Message
+
+
+class MediaGroupAggregator:
+    def __init__(self, handler: Callable[[List[Message]], Awaitable[None]], delay: float = 1.0):
+        self.handler = handler
+        self.delay = delay
+        self._groups: Dict[Tuple[int, str], List[Message]] = {}
+        self._timers: Dict[Tuple[int, str], asyncio.TimerHandle] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def add(self, message: Message):
+        # Telegram delivers album items as separate updates; wait until no new
+        # item arrived for `delay` seconds before handing the album over
+        key = (message.from_user.id, message.media_group_id)
+        self._groups.setdefault(key, []).append(message)
+
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timers[key] = loop.call_later(self.delay, self._flush, key)
+
+    def _flush(self, key: Tuple[int, str]):
+        self._timers.pop(key, None)
+        messages = self._groups.pop(key, [])
+        if not messages:
+            return
+        messages.sort(key=lambda m: m.message_id)
+        task = asyncio.create_task(self._run(messages))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, messages: List[Message]):
+        try:
+            await self.handler(messages)
+        except Exception as e:
+            logging.error(f"Error processing media group: {e}")
+
+    async def wait_closed(self):
+        for key in list(self._timers):
+            self._timers[key].cancel()
+            self._flush(key)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
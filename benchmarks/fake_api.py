@@ -0,0 +1,337 @@
+"""A stand-in Telegram Bot API server for load tests.
+
+    python -m benchmarks.fake_api --port 8081 --latency 0.05 --flood-rate 0.01
+    BOT_API_URL=http://127.0.0.1:8081 python main.py
+
+Implements the methods the handlers use, keeps sticker sets in memory and can
+inject latency, `retry_after` flood errors and STICKERSET_INVALID responses.
+File ids starting with `photo` or `video` are served from generated samples, so
+any such id works with getFile and the download URL. Updates posted to
+/fake/updates are handed out through getUpdates.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import zlib
+from collections import Counter
+from typing import Callable, Dict, List
+
+from aiohttp import web
+
+from benchmarks.image_pipeline import make_sample
+from ratelimit import TokenBucket
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+SET_CAPACITY = 120
+# Methods whose result is a reply the user sees
+REPLY_METHODS = {"sendMessage", "editMessageText", "editMessageReplyMarkup", "answerCallbackQuery"}
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, description: str, retry_after: int | None = None):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+        self.retry_after = retry_after
+
+
+def make_video_samples() -> List[bytes]:
+    if not shutil.which("ffmpeg"):
+        return []
+    samples = []
+    with tempfile.TemporaryDirectory() as directory:
+        for index, size in enumerate(("640x360", "1280x720")):
+            path = os.path.join(directory, f"{index}.mp4")
+            subprocess.run(
+                [
+                    "ffmpeg", "-hide_banner", "-loglevel", "error",
+                    "-f", "lavfi", "-i", f"testsrc2=size={size}:rate=30",
+                    "-t", "4", "-pix_fmt", "yuv420p", "-movflags", "+faststart", "-y", path,
+                ],
+                check=True,
+            )
+            with open(path, "rb") as f:
+                samples.append(f.read())
+    return samples
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        flood_rate: float = 0.0,
+        invalid_rate: float = 0.0,
+        retry_after: int = 1,
+        chat_rate: float = 0.0,
+        videos: bool = True,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.flood_rate = flood_rate
+        self.invalid_rate = invalid_rate
+        self.retry_after = retry_after
+        self.chat_rate = chat_rate
+        self.photos = [
+            make_sample((1280, 720), "RGB", "JPEG"),
+            make_sample((1920, 1080), "RGB", "JPEG"),
+            make_sample((800, 800), "RGBA", "PNG"),
+        ]
+        self.videos = make_video_samples() if videos else []
+        self.files: Dict[str, bytes] = {}
+        self.sets: Dict[str, List[dict]] = {}
+        self.calls = Counter()
+        self.errors = Counter()
+        self.uploaded_bytes = 0
+        self.listeners: List[Callable[[int, str, dict], None]] = []
+        self.updates: asyncio.Queue = asyncio.Queue()
+        self._chats: Dict[int, TokenBucket] = {}
+        self._ids = iter(range(1, 1 << 62))
+
+    def file(self, file_id: str) -> bytes | None:
+        data = self.files.get(file_id)
+        if data is not None:
+            return data
+        # Same id, same sample, so repeats hit the bot's caches like real resends
+        pool = self.videos if file_id.startswith("video") else self.photos if file_id.startswith("photo") else None
+        if not pool:
+            return None
+        return pool[zlib.crc32(file_id.encode()) % len(pool)]
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        app.router.add_post("/fake/updates", self.handle_push_update)
+        app.router.add_get("/fake/stats", self.handle_stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        self.url = f"http://{host}:{runner.addresses[0][1]}"
+        return runner
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "errors": dict(self.errors),
+            "sets": len(self.sets),
+            "stickers": sum(len(stickers) for stickers in self.sets.values()),
+            "uploaded_bytes": self.uploaded_bytes,
+        }
+
+    async def _delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        await self._delay()
+        data = self.file(request.match_info["path"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def handle_push_update(self, request: web.Request) -> web.Response:
+        await self.updates.put(await request.json())
+        return web.json_response({"ok": True})
+
+    async def handle_stats(self, _: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = {}
+        uploads = {}
+        if request.content_type.startswith("multipart/") or request.content_type == "application/x-www-form-urlencoded":
+            for key, value in (await request.post()).items():
+                if isinstance(value, web.FileField):
+                    uploads[key] = value.file.read()
+                else:
+                    params[key] = value
+        elif request.can_read_body:
+            params = await request.json()
+        self.calls[method] += 1
+        self.uploaded_bytes += sum(len(data) for data in uploads.values())
+
+        try:
+            if method != "getUpdates":
+                await self._delay()
+                self._maybe_flood(method, params)
+            handler = getattr(self, f"api_{method}", None)
+            result = await handler(params, uploads) if handler else True
+        except ApiError as e:
+            self.errors[f"{method}:{e.code}"] += 1
+            body = {"ok": False, "error_code": e.code, "description": e.description}
+            if e.retry_after is not None:
+                body["parameters"] = {"retry_after": e.retry_after}
+            return web.json_response(body, status=e.code)
+
+        if method in REPLY_METHODS:
+            chat_id = _chat_id(params)
+            for listener in self.listeners:
+                listener(chat_id, method, params)
+        return web.json_response({"ok": True, "result": result})
+
+    def _maybe_flood(self, method: str, params: dict):
+        if self.flood_rate and random.random() < self.flood_rate:
+            raise ApiError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+        chat_id = params.get("chat_id")
+        if self.chat_rate and chat_id is not None:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, max(1, int(self.chat_rate)))
+            if bucket.time_until_available() > 0:
+                raise ApiError(429, f"Too Many Requests: retry after {self.retry_after}", self.retry_after)
+            bucket.take()
+
+    def _message(self, params: dict) -> dict:
+        chat_id = int(params.get("chat_id") or 0)
+        message = {
+            "message_id": int(params.get("message_id") or next(self._ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if params.get("text"):
+            message["text"] = params["text"]
+        return message
+
+    def _sticker(self, sticker: dict, uploads: dict) -> dict:
+        value = sticker.get("sticker", "")
+        if value.startswith("attach://"):
+            data = uploads.get(value.removeprefix("attach://"), b"")
+            file_id = f"sticker_{next(self._ids)}"
+            self.files[file_id] = data
+        else:
+            file_id = value
+        return {
+            "file_id": file_id,
+            "file_unique_id": f"u_{file_id}",
+            "type": "regular",
+            "width": 512,
+            "height": 512,
+            "is_animated": False,
+            "is_video": sticker.get("format") == "video",
+            "emoji": (sticker.get("emoji_list") or ["😀"])[0],
+        }
+
+    def _set(self, name: str) -> List[dict]:
+        stickers = self.sets.get(name)
+        if stickers is None:
+            raise ApiError(400, "Bad Request: STICKERSET_INVALID")
+        return stickers
+
+    async def api_getMe(self, params, uploads):
+        return BOT_USER
+
+    async def api_getUpdates(self, params, uploads):
+        timeout = float(params.get("timeout") or 0)
+        try:
+            update = await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait()
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return []
+        updates = [update]
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def api_getFile(self, params, uploads):
+        file_id = params["file_id"]
+        data = self.file(file_id)
+        if data is None:
+            raise ApiError(400, "Bad Request: invalid file_id")
+        return {"file_id": file_id, "file_unique_id": file_id, "file_size": len(data), "file_path": file_id}
+
+    async def api_getChatMember(self, params, uploads):
+        user_id = int(params["user_id"])
+        return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+
+    async def api_sendMessage(self, params, uploads):
+        return self._message(params)
+
+    async def api_editMessageText(self, params, uploads):
+        return self._message(params)
+
+    async def api_editMessageReplyMarkup(self, params, uploads):
+        return self._message(params)
+
+    async def api_uploadStickerFile(self, params, uploads):
+        sticker = self._sticker({"sticker": params["sticker"], "format": params.get("sticker_format")}, uploads)
+        return {"file_id": sticker["file_id"], "file_unique_id": sticker["file_unique_id"], "file_size": 0}
+
+    async def api_createNewStickerSet(self, params, uploads):
+        name = params["name"]
+        if name in self.sets:
+            raise ApiError(400, "Bad Request: sticker set name is already occupied")
+        self.sets[name] = [self._sticker(sticker, uploads) for sticker in json.loads(params["stickers"])]
+        return True
+
+    async def api_addStickerToSet(self, params, uploads):
+        if self.invalid_rate and random.random() < self.invalid_rate:
+            raise ApiError(400, "Bad Request: STICKERSET_INVALID")
+        stickers = self._set(params["name"])
+        if len(stickers) >= SET_CAPACITY:
+            raise ApiError(400, "Bad Request: STICKERS_TOO_MUCH")
+        stickers.append(self._sticker(json.loads(params["sticker"]), uploads))
+        return True
+
+    async def api_getStickerSet(self, params, uploads):
+        name = params["name"]
+        return {"name": name, "title": name, "sticker_type": "regular", "stickers": self._set(name)}
+
+    async def api_deleteStickerFromSet(self, params, uploads):
+        for stickers in self.sets.values():
+            stickers[:] = [sticker for sticker in stickers if sticker["file_id"] != params["sticker"]]
+        return True
+
+
+def _chat_id(params: dict) -> int | None:
+    # answerCallbackQuery has no chat; the load generator encodes the user in the query id
+    value = params.get("chat_id") or params.get("callback_query_id", "").partition(":")[0]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def serve(args):
+    api = FakeBotAPI(args.latency, args.jitter, args.flood_rate, args.invalid_rate, args.retry_after, args.chat_rate)
+    runner = await api.start(args.host, args.port)
+    print(f"Fake Bot API on {api.url} (stats at {api.url}/fake/stats)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", type=float, default=0.03, help="base delay per request, seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="extra random delay up to this many seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--invalid-rate", type=float, default=0.0, help="share of addStickerToSet answered with STICKERSET_INVALID")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--chat-rate", type=float, default=0.0, help="messages per second per chat before 429, 0 is unlimited")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    add_arguments(parser)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
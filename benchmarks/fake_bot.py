@@ -0,0 +1,85 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetChatMember, GetFile, GetMe, SendMessage, TelegramMethod, UploadStickerFile
+from aiogram.types import Chat, ChatMemberMember, File, Message, PhotoSize, User
+
+FAKE_TOKEN = "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+BOT_USER = User(id=123456, is_bot=True, first_name="Bench", username="bench_bot")
+
+
+class FakeSession(BaseSession):
+    """Answers Bot API calls in-process, serving downloads from `files`."""
+
+    def __init__(self, files: dict[str, bytes] | None = None, latency: float = 0.0):
+        super().__init__()
+        self.files = files if files is not None else {}
+        self.latency = latency
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+
+    async def close(self):
+        pass
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.calls[type(method).__name__] += 1
+
+        for input_file in _input_files(method):
+            async for chunk in input_file.read(bot):
+                self.uploaded_bytes += len(chunk)
+
+        if isinstance(method, GetFile):
+            data = self.files.get(method.file_id, b"")
+            return File(
+                file_id=method.file_id,
+                file_unique_id=method.file_id,
+                file_size=len(data),
+                file_path=method.file_id,
+            )
+        if isinstance(method, UploadStickerFile):
+            return File(file_id=f"uploaded_{self.calls[type(method).__name__]}", file_unique_id="uploaded")
+        if isinstance(method, SendMessage):
+            return make_message(method.chat_id, text=method.text, bot=bot, from_user=BOT_USER)
+        if isinstance(method, GetMe):
+            return BOT_USER
+        if isinstance(method, GetChatMember):
+            return ChatMemberMember(user=User(id=method.user_id, is_bot=False, first_name="User"))
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        data = self.files.get(url.rsplit("/", 1)[-1], b"")
+        for offset in range(0, len(data), chunk_size):
+            yield data[offset:offset + chunk_size]
+
+
+def _input_files(method: TelegramMethod):
+    stickers = getattr(method, "stickers", None) or [getattr(method, "sticker", None)]
+    for sticker in stickers:
+        value = getattr(sticker, "sticker", sticker)
+        if hasattr(value, "read") and not isinstance(value, str):
+            yield value
+
+
+_message_ids = iter(range(1, 1 << 62))
+
+
+def make_message(chat_id, bot: Bot, from_user: User | None = None, **fields) -> Message:
+    user = from_user or User(id=int(chat_id), is_bot=False, first_name="User")
+    return Message(
+        message_id=next(_message_ids),
+        date=datetime.fromtimestamp(time.time()),
+        chat=Chat(id=int(chat_id), type="private"),
+        from_user=user,
+        **fields,
+    ).as_(bot)
+
+
+def make_photo_message(user_id: int, file_id: str, bot: Bot, size: int = 0, **fields) -> Message:
+    photo = PhotoSize(file_id=file_id, file_unique_id=file_id, width=512, height=512, file_size=size)
+    return make_message(user_id, bot=bot, photo=[photo], **fields)
@@ -0,0 +1,96 @@
+"""Compare the sticker image pipeline against the original implementation.
+
+    python -m benchmarks.image_pipeline [--repeat 10]
+
+Prints per-image latency and output size for the legacy PNG pipeline and
+for the current pipeline in PNG and WebP modes.
+"""
+import argparse
+import statistics
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from utils import process_image
+
+
+def legacy_process_image(image_data: BytesIO, is_emoji: bool = False) -> BytesIO:
+    # utils.process_image before the draft/reduce fast path
+    with Image.open(image_data) as img:
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+
+        if is_emoji:
+            img.thumbnail((100, 100), Image.Resampling.LANCZOS)
+            canvas = Image.new("RGBA", (100, 100), (0, 0, 0, 0))
+            canvas.paste(img, ((100 - img.width) // 2, (100 - img.height) // 2))
+            img = canvas
+        else:
+            width, height = img.size
+            if width >= height:
+                new_width, new_height = 512, int(height * (512 / width))
+            else:
+                new_width, new_height = int(width * (512 / height)), 512
+            img = img.resize((max(1, new_width), max(1, new_height)), Image.Resampling.LANCZOS)
+
+        output = BytesIO()
+        img.save(output, format="PNG")
+        output.seek(0)
+        return output
+
+
+def make_sample(size: tuple[int, int], mode: str, fmt: str) -> bytes:
+    # Gradient plus noise looks enough like a photo to keep encoders honest
+    noise = Image.effect_noise(size, 48).convert("L")
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    if mode != "RGB":
+        img = img.convert(mode)
+    output = BytesIO()
+    img.save(output, format=fmt, **({"quality": 90} if fmt == "JPEG" else {}))
+    return output.getvalue()
+
+
+SAMPLES = {
+    "jpeg_12mp": ((4032, 3024), "RGB", "JPEG"),
+    "jpeg_1080p": ((1920, 1080), "RGB", "JPEG"),
+    "png_rgba_2k": ((2048, 2048), "RGBA", "PNG"),
+    "png_p_800": ((800, 600), "P", "PNG"),
+}
+
+PIPELINES = {
+    "legacy_png": lambda data, is_emoji: legacy_process_image(BytesIO(data), is_emoji),
+    "png_level3": lambda data, is_emoji: process_image(BytesIO(data), is_emoji, "png", 3),
+    "png_level6": lambda data, is_emoji: process_image(BytesIO(data), is_emoji, "png", 6),
+    "webp": lambda data, is_emoji: process_image(BytesIO(data), is_emoji, "webp"),
+}
+
+
+def measure(func, data: bytes, is_emoji: bool, repeat: int):
+    timings = []
+    size = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        size = len(func(data, is_emoji).getvalue())
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'sample':<14} {'target':<8} {'pipeline':<12} {'median ms':>10} {'bytes':>9}")
+    for name, spec in SAMPLES.items():
+        data = make_sample(*spec)
+        for is_emoji in (False, True):
+            for pipeline, func in PIPELINES.items():
+                latency, size = measure(func, data, is_emoji, args.repeat)
+                target = "emoji" if is_emoji else "regular"
+                print(f"{name:<14} {target:<8} {pipeline:<12} {latency:>10.1f} {size:>9}")
+
+
+if __name__ == "__main__":
+    main()
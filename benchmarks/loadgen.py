@@ -0,0 +1,252 @@
+"""Load test for the whole bot against the fake Bot API server.
+
+    python -m benchmarks.loadgen --users 1000 --duration 60
+    python -m benchmarks.loadgen --users 200 --flood-rate 0.02 --invalid-rate 0.01 --mix photo=5,album=2,tap=3
+
+Simulated users send photos, albums, videos and button taps. Their updates go
+through the dispatcher from loader.py with all middlewares, and the bot talks
+HTTP to benchmarks/fake_api.py. Latency is measured from the update to the
+reply the user would see: the bot's message for media, the callback answer for
+taps. Bot settings come from the environment as usual; the outbound rate
+limiter (API_GLOBAL_RATE) is usually what bounds throughput.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+os.environ.setdefault("BOT_TOKEN", "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+os.environ.setdefault("METRICS_PORT", "0")
+
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import CallbackQuery, Chat, Message, PhotoSize, Update, User, Video
+
+from benchmarks.fake_api import FakeBotAPI, add_arguments
+from benchmarks.run import RESULTS_DIR, git_commit, peak_rss_kb, summarize
+
+# Replies that mean the user did not get their sticker
+ERROR_MARKERS = ("Не удалось", "Ошибка", "Не получилось", "Очередь забита", "Слишком долго", "не влезает")
+
+
+class LoadGenerator:
+    def __init__(self, api: FakeBotAPI, args):
+        self.api = api
+        self.args = args
+        self.mix = {}
+        for part in args.mix.split(","):
+            kind, _, weight = part.partition("=")
+            self.mix[kind.strip()] = float(weight or 1)
+        if "video" in self.mix and not api.videos:
+            print("ffmpeg not found, videos are sent as photos")
+            self.mix["photo"] = self.mix.get("photo", 0) + self.mix.pop("video")
+        self.timings = defaultdict(list)
+        self.outcomes = defaultdict(Counter)
+        self.error_texts = Counter()
+        self.pending = {}
+        self.tasks = set()
+        self._ids = iter(range(1, 1 << 62))
+        api.listeners.append(self.on_reply)
+
+    def on_reply(self, chat_id, method: str, params: dict):
+        waiter = self.pending.get(chat_id)
+        if waiter is None:
+            return
+        expected, future = waiter
+        if method == expected and not future.done():
+            future.set_result(params.get("text") or "")
+
+    def _message(self, user: User, **fields) -> Message:
+        from loader import bot
+
+        return Message(
+            message_id=next(self._ids),
+            date=datetime.fromtimestamp(time.time()),
+            chat=Chat(id=user.id, type="private"),
+            from_user=user,
+            **fields,
+        ).as_(bot)
+
+    def _photo_id(self, user_id: int) -> str:
+        if random.random() < self.args.unique:
+            return f"photo_{user_id}_{next(self._ids)}"
+        # A shared pool, like memes everyone forwards
+        return f"photo_shared_{random.randrange(50)}"
+
+    def _updates(self, kind: str, user: User, pack_id: int) -> list[Update]:
+        if kind == "photo":
+            file_id = self._photo_id(user.id)
+            photo = PhotoSize(file_id=file_id, file_unique_id=file_id, width=1280, height=720)
+            messages = [self._message(user, photo=[photo])]
+        elif kind == "album":
+            group_id = str(next(self._ids))
+            messages = []
+            for _ in range(random.randint(2, self.args.album_size)):
+                file_id = self._photo_id(user.id)
+                photo = PhotoSize(file_id=file_id, file_unique_id=file_id, width=1280, height=720)
+                messages.append(self._message(user, photo=[photo], media_group_id=group_id))
+        elif kind == "video":
+            file_id = f"video_{user.id}_{next(self._ids)}"
+            video = Video(file_id=file_id, file_unique_id=file_id, width=1280, height=720, duration=4)
+            messages = [self._message(user, video=video)]
+        else:
+            data = random.choice(["packs_page_0", f"select_{pack_id}_0", "stats"])
+            query = CallbackQuery(
+                id=f"{user.id}:{next(self._ids)}",
+                from_user=user,
+                chat_instance="load",
+                data=data,
+                message=self._message(user, text="menu"),
+            )
+            return [Update(update_id=next(self._ids), callback_query=query)]
+        return [Update(update_id=next(self._ids), message=message) for message in messages]
+
+    async def act(self, kind: str, user: User, pack_id: int):
+        from loader import bot, dp
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[user.id] = ("answerCallbackQuery" if kind == "tap" else "sendMessage", future)
+        started = time.perf_counter()
+        # Polling hands every update to its own task, so do the same
+        for update in self._updates(kind, user, pack_id):
+            task = asyncio.create_task(dp.feed_update(bot, update))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        try:
+            text = await asyncio.wait_for(future, self.args.timeout)
+        except asyncio.TimeoutError:
+            self.outcomes[kind]["timeout"] += 1
+            return
+        finally:
+            self.pending.pop(user.id, None)
+        self.timings[kind].append(time.perf_counter() - started)
+        if any(marker in text for marker in ERROR_MARKERS):
+            self.outcomes[kind]["error"] += 1
+            self.error_texts[text.splitlines()[-1][:120]] += 1
+        else:
+            self.outcomes[kind]["ok"] += 1
+
+    async def user_session(self, user_id: int, pack_id: int, deadline: float):
+        user = User(id=user_id, is_bot=False, first_name=f"User {user_id}")
+        kinds, weights = list(self.mix), list(self.mix.values())
+        # Spread the start so the first second is not a thundering herd
+        await asyncio.sleep(random.uniform(0, self.args.ramp))
+        while time.monotonic() < deadline:
+            await self.act(random.choices(kinds, weights)[0], user, pack_id)
+            await asyncio.sleep(random.expovariate(1 / self.args.think))
+
+    def report(self, wall_time: float) -> dict:
+        results = {}
+        everything = []
+        for kind in self.mix:
+            outcomes = self.outcomes[kind]
+            total = sum(outcomes.values())
+            if not total:
+                continue
+            everything.extend(self.timings[kind])
+            stats = summarize(self.timings[kind], wall_time) if self.timings[kind] else {}
+            stats.update(
+                actions=total,
+                errors=outcomes["error"],
+                timeouts=outcomes["timeout"],
+                error_rate=round((outcomes["error"] + outcomes["timeout"]) / total, 4),
+            )
+            results[f"load.{kind}"] = stats
+        if everything:
+            failed = sum(outcomes["error"] + outcomes["timeout"] for outcomes in self.outcomes.values())
+            total = sum(sum(outcomes.values()) for outcomes in self.outcomes.values())
+            results["load.all"] = {**summarize(everything, wall_time), "actions": total, "error_rate": round(failed / total, 4)}
+        return results
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.latency, args.jitter, args.flood_rate, args.invalid_rate, args.retry_after, args.chat_rate)
+    api_runner = await api.start()
+
+    import database
+    import main as bot_main
+    from loader import bot, rate_limiter, sticker_cache, throttling
+
+    directory = tempfile.mkdtemp(prefix="loadgen-")
+    database.db.path = os.path.join(directory, "load.db")
+    sticker_cache.directory = os.path.join(directory, "cache")
+    bot.session.api = TelegramAPIServer.from_base(api.url)
+    bot_main.setup_dispatcher()
+    await bot_main.on_startup()
+
+    generator = LoadGenerator(api, args)
+    users = list(range(1, args.users + 1))
+    packs = {}
+    for user_id in users:
+        packs[user_id] = await database.create_pack(user_id, f"load_{user_id}_by_fake_bot", "Load", "regular", select=True)
+
+    print(f"{args.users} users for {args.duration}s against {api.url}...")
+    started = time.perf_counter()
+    deadline = time.monotonic() + args.duration
+    try:
+        await asyncio.gather(*(generator.user_session(user_id, packs[user_id], deadline) for user_id in users))
+        wall_time = time.perf_counter() - started
+        if generator.tasks:
+            await asyncio.wait(set(generator.tasks), timeout=args.timeout)
+    finally:
+        await bot_main.on_shutdown()
+        await bot.session.close()
+        await api_runner.cleanup()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "results": generator.report(wall_time),
+        "top_errors": dict(generator.error_texts.most_common(10)),
+        "api": api.stats(),
+        "bot": {"rate_limiter": dict(rate_limiter.metrics), "throttling": dict(throttling.metrics)},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=60, help="seconds of traffic")
+    parser.add_argument("--ramp", type=float, default=5, help="users start within this many seconds")
+    parser.add_argument("--think", type=float, default=5, help="mean pause between a user's actions")
+    parser.add_argument("--mix", default="photo=5,album=2,video=1,tap=2")
+    parser.add_argument("--album-size", type=int, default=5)
+    parser.add_argument("--unique", type=float, default=0.7, help="share of photos never seen before")
+    parser.add_argument("--timeout", type=float, default=60, help="give up waiting for a reply after this long")
+    parser.add_argument("--output", help="result file, defaults to benchmarks/results/")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    report["meta"] = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+    report["peak_rss_kb"] = peak_rss_kb()
+
+    for name, stats in report["results"].items():
+        latency = f"p50 {stats['p50_ms']:>9.2f}  p95 {stats['p95_ms']:>9.2f}  p99 {stats['p99_ms']:>9.2f} ms" if "p50_ms" in stats else ""
+        print(f"  {name:<14} {stats['actions']:>7} actions  errors {stats['error_rate'] * 100:5.1f}%  {latency}")
+    print(f"  API calls: {report['api']['calls']}")
+    print(f"  API errors: {report['api']['errors']}")
+    print(f"  bot retries: {report['bot']['rate_limiter']}")
+    for text, count in report["top_errors"].items():
+        print(f"  {count:>6} x {text}")
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit']}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+
+if __name__ == "__main__":
+    main()
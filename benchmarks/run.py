@@ -0,0 +1,326 @@
+"""Benchmark suite for the media hot paths, the database and the handlers.
+
+    python -m benchmarks.run [--quick] [--only image,video,db,handler]
+    python -m benchmarks.run --compare benchmarks/results/OLD.json
+
+Everything runs locally against synthetic inputs and a stubbed Bot session, so
+no network or Telegram token is needed. Results are written as JSON to
+benchmarks/results/<timestamp>-<commit>.json; --compare prints the p50 change
+against an earlier run.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+os.environ.setdefault("BOT_TOKEN", "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA")
+
+import PIL
+from PIL import Image
+
+from benchmarks.image_pipeline import make_sample
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def summarize(timings: list[float], wall_time: float | None = None) -> dict:
+    ordered = sorted(timings)
+
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    wall_time = wall_time if wall_time is not None else sum(timings)
+    return {
+        "count": len(ordered),
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+        "ops_per_sec": round(len(ordered) / wall_time, 2) if wall_time else None,
+    }
+
+
+def timed(func, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return summarize(timings)
+
+
+def make_animated_gif(size: tuple[int, int], frames: int) -> bytes:
+    images = [Image.effect_noise(size, 32 + i * 4).convert("P") for i in range(frames)]
+    output = BytesIO()
+    images[0].save(output, format="GIF", save_all=True, append_images=images[1:], duration=80, loop=0)
+    return output.getvalue()
+
+
+def image_samples(quick: bool) -> dict[str, bytes]:
+    samples = {
+        "jpeg_rgb_1080p": make_sample((1920, 1080), "RGB", "JPEG"),
+        "jpeg_cmyk_1080p": make_sample((1920, 1080), "CMYK", "JPEG"),
+        "png_p_800": make_sample((800, 600), "P", "PNG"),
+        "png_la_1024": make_sample((1024, 1024), "LA", "PNG"),
+        "gif_animated_480": make_animated_gif((480, 360), 10),
+    }
+    if not quick:
+        samples["jpeg_rgb_12mp"] = make_sample((4032, 3024), "RGB", "JPEG")
+        samples["png_rgba_2k"] = make_sample((2048, 2048), "RGBA", "PNG")
+    return samples
+
+
+def bench_image(repeat: int, quick: bool) -> dict:
+    from utils import process_image
+
+    results = {}
+    for name, data in image_samples(quick).items():
+        for is_emoji in (False, True):
+            target = "emoji" if is_emoji else "regular"
+            stats = timed(lambda: process_image(BytesIO(data), is_emoji=is_emoji), repeat)
+            stats["output_bytes"] = len(process_image(BytesIO(data), is_emoji=is_emoji).getvalue())
+            results[f"image.{name}.{target}"] = stats
+    return results
+
+
+def make_clip(directory: str, name: str, args: list[str]) -> bytes:
+    path = os.path.join(directory, name)
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi", *args, "-y", path],
+        check=True,
+    )
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def bench_video(repeat: int, quick: bool) -> dict:
+    from utils import process_video
+
+    if not shutil.which("ffmpeg") or not shutil.which("ffprobe"):
+        print("  ffmpeg/ffprobe not found, skipping video benchmarks")
+        return {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = ["-i", "testsrc2=size=1280x720:rate=30", "-t", "5", "-pix_fmt", "yuv420p"]
+        clips = {
+            # The mp4 muxer writes moov last by default, which takes the temp-file path
+            "mp4_moov_end_720p": make_clip(directory, "a.mp4", source),
+            "mp4_faststart_720p": make_clip(directory, "b.mp4", [*source, "-movflags", "+faststart"]),
+            "webm_720p": make_clip(directory, "c.webm", [*source, "-c:v", "libvpx-vp9", "-deadline", "realtime"]),
+        }
+    if quick:
+        clips.pop("webm_720p")
+
+    results = {}
+    for name, data in clips.items():
+        for is_emoji in (False, True):
+            target = "emoji" if is_emoji else "regular"
+            stats = timed(lambda: process_video(BytesIO(data), is_emoji=is_emoji), repeat)
+            stats["output_bytes"] = len(process_video(BytesIO(data), is_emoji=is_emoji).getvalue())
+            results[f"video.{name}.{target}"] = stats
+    return results
+
+
+async def bench_db(repeat: int, directory: str) -> dict:
+    import database
+
+    database.db.path = os.path.join(directory, "bench.db")
+    await database.init_db()
+
+    users = list(range(1, 201))
+    for user_id in users:
+        for index in range(5):
+            await database.create_pack(user_id, f"p_{user_id}_{index}", f"Pack {index}", "regular", select=True)
+
+    async def run(name: str, make_call):
+        timings = []
+        started = time.perf_counter()
+        for i in range(repeat):
+            call_started = time.perf_counter()
+            await make_call(users[i % len(users)])
+            timings.append(time.perf_counter() - call_started)
+        return name, summarize(timings, time.perf_counter() - started)
+
+    cases = [
+        ("db.get_user_packs_page", lambda user_id: database.get_user_packs_page(user_id, 0, 8)),
+        ("db.get_user_current_pack", database.get_user_current_pack),
+        ("db.get_user_stats", database.get_user_stats),
+        ("db.set_user_current_pack_id", lambda user_id: database.set_user_current_pack_id(user_id, user_id)),
+    ]
+    results = dict([await run(name, call) for name, call in cases])
+
+    # The same reads issued concurrently, as many updates would
+    timings = []
+
+    async def one(user_id: int):
+        call_started = time.perf_counter()
+        await database.get_user_packs_page(user_id, 0, 8)
+        timings.append(time.perf_counter() - call_started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(users[i % len(users)]) for i in range(repeat)))
+    results["db.get_user_packs_page.concurrent"] = summarize(timings, time.perf_counter() - started)
+
+    await database.db.close()
+    return results
+
+
+async def bench_handler(repeat: int, concurrency: int, directory: str) -> dict:
+    import database
+    import handlers
+    import loader
+    from benchmarks.fake_bot import FakeSession, make_photo_message
+
+    database.db.path = os.path.join(directory, "handler.db")
+    await database.init_db()
+    loader.sticker_cache.directory = os.path.join(directory, "cache")
+
+    photo = make_sample((1920, 1080), "RGB", "JPEG")
+    session = FakeSession()
+    loader.bot.session = session
+    loader.media_engine.start()
+
+    users = list(range(1, concurrency + 1))
+    for user_id in users:
+        await database.create_pack(user_id, f"h_{user_id}", "Bench", "regular", select=True)
+
+    async def run(unique: bool):
+        timings = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(i: int):
+            file_id = f"photo_{i}" if unique else "photo_shared"
+            session.files[file_id] = photo
+            message = make_photo_message(users[i % len(users)], file_id, loader.bot, size=len(photo))
+            async with semaphore:
+                started = time.perf_counter()
+                await handlers.process_media_item(message, message.from_user.id)
+                timings.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(repeat)))
+        return summarize(timings, time.perf_counter() - started)
+
+    # Spin up the pool workers and fill the cache for the shared file outside the timings
+    session.files["photo_shared"] = photo
+    await asyncio.gather(*(
+        handlers.process_media_item(message, message.from_user.id)
+        for message in [make_photo_message(user_id, "photo_shared", loader.bot) for user_id in users]
+    ))
+    session.calls.clear()
+
+    results = {
+        "handler.process_media_item.cold": await run(unique=True),
+        "handler.process_media_item.cached": await run(unique=False),
+    }
+    results["handler.process_media_item.cold"]["api_calls"] = dict(session.calls)
+
+    await loader.media_engine.shutdown()
+    await database.db.close()
+    return results
+
+
+def peak_rss_kb() -> dict:
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old_path: str, new: dict):
+    with open(old_path) as f:
+        old = json.load(f)
+    print(f"\nCompared with {old['meta']['commit']} ({old_path}):")
+    for name, stats in new["results"].items():
+        before = old["results"].get(name)
+        if not before:
+            continue
+        change = (stats["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0
+        print(f"  {name:<55} p50 {before['p50_ms']:>9.2f} -> {stats['p50_ms']:>9.2f} ms ({change:+.1f}%)")
+
+
+async def run_async(args, sections: set[str], directory: str) -> dict:
+    results = {}
+    if "db" in sections:
+        print("database...")
+        results.update(await bench_db(args.repeat * 20, directory))
+    if "handler" in sections:
+        print("handler...")
+        results.update(await bench_handler(args.repeat * 4, args.concurrency, directory))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--quick", action="store_true", help="fewer and smaller samples")
+    parser.add_argument("--only", default="image,video,db,handler")
+    parser.add_argument("--output", help="result file, defaults to benchmarks/results/")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+    if args.quick:
+        args.repeat = min(args.repeat, 3)
+    sections = set(args.only.split(","))
+
+    results = {}
+    if "image" in sections:
+        print("image...")
+        results.update(bench_image(args.repeat, args.quick))
+    if "video" in sections:
+        print("video...")
+        results.update(bench_video(max(1, args.repeat // 3), args.quick))
+    with tempfile.TemporaryDirectory() as directory:
+        results.update(asyncio.run(run_async(args, sections, directory)))
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "pillow": PIL.__version__,
+            "args": vars(args),
+        },
+        "peak_rss_kb": peak_rss_kb(),
+        "results": results,
+    }
+
+    for name, stats in results.items():
+        print(f"  {name:<55} p50 {stats['p50_ms']:>9.2f}  p95 {stats['p95_ms']:>9.2f}  p99 {stats['p99_ms']:>9.2f} ms")
+    print(f"  peak RSS: {report['peak_rss_kb']['self']} KB (workers {report['peak_rss_kb']['children']} KB)")
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit']}.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {output}")
+
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+
+from cachetools import LRUCache, TTLCache
+
+
+class StickerCache:
+    def __init__(self, directory: str, memory_bytes: int, disk_bytes: int, file_id_ttl: float = 24 * 60 * 60):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self._memory = LRUCache(maxsize=max(1, memory_bytes), getsizeof=len)
+        # file_ids returned by uploadStickerFile belong to the uploading user
+        self._file_ids = TTLCache(maxsize=100_000, ttl=file_id_ttl)
+        self._disk_size: int | None = None
+        self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def key(file_unique_id: str, variant: str) -> str:
+        return f"{file_unique_id}:{variant}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def get_file_id(self, user_id: int, key: str) -> tuple[str, str] | None:
+        # (file_id, sticker format): an animated image uploads as a video sticker
+        return self._file_ids.get((user_id, key))
+
+    def put_file_id(self, user_id: int, key: str, file_id: str, sticker_format: str):
+        self._file_ids[(user_id, key)] = (file_id, sticker_format)
+
+    def drop_file_id(self, user_id: int, key: str):
+        self._file_ids.pop((user_id, key), None)
+
+    async def get(self, key: str) -> bytes | None:
+        data = self._memory.get(key)
+        if data is not None:
+            return data
+        if not self.disk_bytes:
+            return None
+        data = await asyncio.to_thread(self._read_disk, key)
+        if data is not None:
+            self._store_memory(key, data)
+        return data
+
+    async def put(self, key: str, data: bytes):
+        self._store_memory(key, data)
+        if self.disk_bytes:
+            try:
+                await asyncio.to_thread(self._write_disk, key, data)
+            except OSError as e:
+                logging.warning(f"Sticker cache write failed: {e}")
+
+    def _store_memory(self, key: str, data: bytes):
+        if len(data) <= self._memory.maxsize:
+            self._memory[key] = data
+
+    def _read_disk(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # mtime doubles as the access time for eviction
+            os.utime(path)
+            return data
+        except OSError:
+            return None
+
+    def _write_disk(self, key: str, data: bytes):
+        with self._disk_lock:
+            if self._disk_size is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._disk_size = sum(entry.stat().st_size for entry in os.scandir(self.directory))
+
+            path = self._path(key)
+            if os.path.exists(path):
+                self._disk_size -= os.path.getsize(path)
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self._disk_size += len(data)
+
+            if self._disk_size > self.disk_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+        # Trim to 90% so a full cache does not rescan the directory on every write
+        target = self.disk_bytes * 0.9
+        for entry in entries:
+            if self._disk_size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self._disk_size -= size
+
+
+class MenuCache:
+    """Rendered pack keyboards per (user, page, selected pack)."""
+
+    def __init__(self, ttl: float, maxsize: int = 10_000):
+        self._users = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, user_id: int, page: int, current_pack_id: int | None):
+        pages = self._users.get(user_id)
+        return pages.get((page, current_pack_id)) if pages else None
+
+    def put(self, user_id: int, page: int, current_pack_id: int | None, markup):
+        pages = self._users.get(user_id)
+        if pages is None:
+            pages = self._users[user_id] = {}
+        pages[(page, current_pack_id)] = markup
+
+    def invalidate(self, user_id: int):
+        self._users.pop(user_id, None)
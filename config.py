@@ -6,4 +6,81 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 CHANNEL_URL = os.getenv("CHANNEL_URL")
+# e.g. a local telegram-bot-api server or benchmarks/fake_api.py
+BOT_API_URL = os.getenv("BOT_API_URL")
 DB_NAME = "stickers.db"
+
+MEDIA_QUEUE_LIMIT = int(os.getenv("MEDIA_QUEUE_LIMIT", 32))
+MEDIA_JOB_TIMEOUT = float(os.getenv("MEDIA_JOB_TIMEOUT", 60))
+MEDIA_GROUP_DELAY = float(os.getenv("MEDIA_GROUP_DELAY", 1))
+# getFile serves at most 20 MB; inputs above MEDIA_SPOOL_BYTES go to a temp file
+MEDIA_MAX_INPUT_BYTES = int(os.getenv("MEDIA_MAX_INPUT_BYTES", 20 * 1024 * 1024))
+MEDIA_SPOOL_BYTES = int(os.getenv("MEDIA_SPOOL_BYTES", 4 * 1024 * 1024))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+CACHE_MEMORY_BYTES = int(os.getenv("CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+CACHE_DISK_BYTES = int(os.getenv("CACHE_DISK_BYTES", 512 * 1024 * 1024))
+
+STICKER_IMAGE_FORMAT = os.getenv("STICKER_IMAGE_FORMAT", "png").lower()
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", 3))
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 1))
+
+# Webhook workers each start their own media pool, so split the cores between them
+_media_processes = WEBHOOK_WORKERS if BOT_MODE == "webhook" else 1
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", max(1, (os.cpu_count() or 2) // _media_processes)))
+
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 24 * 60 * 60))
+# Set when several processes read and write the same fsm_states table
+FSM_SHARED = os.getenv("FSM_SHARED", "0") == "1" or (BOT_MODE == "webhook" and WEBHOOK_WORKERS > 1)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+THROTTLE_RATE = float(os.getenv("THROTTLE_RATE", 2))
+THROTTLE_BURST = int(os.getenv("THROTTLE_BURST", 5))
+THROTTLE_QUEUE_LIMIT = int(os.getenv("THROTTLE_QUEUE_LIMIT", 10))
+THROTTLE_MAX_ACTIVE = int(os.getenv("THROTTLE_MAX_ACTIVE", 64))
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9090))
+
+SUBSCRIPTION_POSITIVE_TTL = float(os.getenv("SUBSCRIPTION_POSITIVE_TTL", 600))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", 30))
+
+API_GLOBAL_RATE = float(os.getenv("API_GLOBAL_RATE", 30))
+API_CHAT_RATE = float(os.getenv("API_CHAT_RATE", 1))
+API_CHAT_BURST = int(os.getenv("API_CHAT_BURST", 3))
+API_MAX_ATTEMPTS = int(os.getenv("API_MAX_ATTEMPTS", 5))
+# Per user (the set owner), not bot-wide
+API_STICKER_ADD_RATE = float(os.getenv("API_STICKER_ADD_RATE", 5))
+API_STICKER_ADD_BURST = int(os.getenv("API_STICKER_ADD_BURST", 5))
+API_SET_CREATE_RATE = float(os.getenv("API_SET_CREATE_RATE", 1))
+API_SET_CREATE_BURST = int(os.getenv("API_SET_CREATE_BURST", 2))
+API_STICKER_UPLOAD_RATE = float(os.getenv("API_STICKER_UPLOAD_RATE", 5))
+API_STICKER_UPLOAD_BURST = int(os.getenv("API_STICKER_UPLOAD_BURST", 5))
+
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", MEDIA_WORKERS))
+IMPORT_UPLOAD_CONCURRENCY = int(os.getenv("IMPORT_UPLOAD_CONCURRENCY", 1))
+IMPORT_MAX_ENTRY_BYTES = int(os.getenv("IMPORT_MAX_ENTRY_BYTES", 10 * 1024 * 1024))
+
+# off: albums are handled right in the update handler
+# local: queued in SQLite and run by a worker inside the bot process
+# remote: queued only, run by `python worker.py` on the same host (WAL needs local disk)
+JOB_QUEUE = os.getenv("JOB_QUEUE", "off")
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", MEDIA_WORKERS))
+
+PACKS_PAGE_SIZE = int(os.getenv("PACKS_PAGE_SIZE", 8))
+MENU_CACHE_TTL = float(os.getenv("MENU_CACHE_TTL", 600))
+
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", 5))
+# Telegram user ids allowed to see /admin_stats
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
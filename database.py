@@ -1,9 +1,115 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Iterable
+
 import aiosqlite
-from config import DB_NAME
+from config import DB_NAME, DB_POOL_SIZE
+from metrics import DB_QUERY_SECONDS
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA busy_timeout = 5000",
+)
+
+
+class Database:
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self.pool_size = max(1, pool_size)
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._connections: list[aiosqlite.Connection] = []
+
+    async def _open(self) -> aiosqlite.Connection:
+        # Autocommit mode: transactions are opened explicitly in `transaction()`
+        conn = await aiosqlite.connect(self.path, isolation_level=None, cached_statements=256)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        self._connections.append(conn)
+        return conn
+
+    async def connect(self):
+        if self._writer is not None:
+            return
+        self._writer = await self._open()
+        for _ in range(self.pool_size):
+            self._readers.put_nowait(await self._open())
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections.clear()
+        self._writer = None
+        self._readers = asyncio.Queue()
+
+    @asynccontextmanager
+    async def reader(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        # Timed including the wait for the write lock, which is what callers feel
+        with DB_QUERY_SECONDS.labels("transaction").time():
+            async with self._write_lock:
+                await self._writer.execute("BEGIN IMMEDIATE")
+                try:
+                    yield self._writer
+                except BaseException:
+                    await self._writer.execute("ROLLBACK")
+                    raise
+                await self._writer.execute("COMMIT")
+
+    async def fetchone(self, sql: str, params: Iterable = ()):
+        with DB_QUERY_SECONDS.labels("fetchone").time():
+            async with self.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchone()
+
+    async def fetchall(self, sql: str, params: Iterable = ()):
+        with DB_QUERY_SECONDS.labels("fetchall").time():
+            async with self.reader() as conn:
+                async with conn.execute(sql, params) as cursor:
+                    return await cursor.fetchall()
+
+    async def execute(self, sql: str, params: Iterable = ()):
+        async with self.transaction() as conn:
+            cursor = await conn.execute(sql, params)
+            return cursor.lastrowid
+
+    async def executemany(self, sql: str, rows: Iterable[Iterable]):
+        async with self.transaction() as conn:
+            await conn.executemany(sql, rows)
+
+
+db = Database(DB_NAME, DB_POOL_SIZE)
+
+# Event counters kept per user, globally and per day
+STATS_METRICS = (
+    "packs_created",
+    "packs_deleted",
+    "stickers_added",
+    "stickers_deleted",
+    "bytes_in",
+    "bytes_out",
+    "failures",
+)
+
 
 async def init_db():
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
+    await db.connect()
+    async with db.transaction() as conn:
+        await conn.execute(
             """
             CREATE TABLE IF NOT EXISTS packs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -15,15 +121,39 @@ async def init_db():
             )
             """
         )
-        
-        try:
-            await db.execute("SELECT pack_type FROM packs LIMIT 1")
-        except Exception:
-            print("Migrating database: adding pack_type column...")
-            await db.execute("ALTER TABLE packs ADD COLUMN pack_type TEXT DEFAULT 'regular'")
-            await db.commit()
-            
-        await db.execute(
+
+        async with conn.execute("PRAGMA table_info(packs)") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if "pack_type" not in columns:
+            logging.info("Migrating database: adding pack_type column...")
+            await conn.execute("ALTER TABLE packs ADD COLUMN pack_type TEXT DEFAULT 'regular'")
+
+        if "synced_at" not in columns:
+            await conn.execute("ALTER TABLE packs ADD COLUMN synced_at REAL")
+
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_packs_user_id ON packs (user_id, id)")
+        # Local mirror of what is in each Telegram set. Rows added through the bot
+        # have no file ids until the pack is reconciled with getStickerSet
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stickers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pack_id INTEGER NOT NULL,
+                file_id TEXT,
+                file_unique_id TEXT,
+                emoji TEXT,
+                created_at REAL
+            )
+            """
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_stickers_pack_id ON stickers (pack_id)")
+        # The same sticker may sit in several of a user's packs; an index over
+        # file_unique_id alone made reconciling one pack delete it from the other
+        await conn.execute("DROP INDEX IF EXISTS idx_stickers_file_unique_id")
+        await conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_stickers_pack_unique_id ON stickers (pack_id, file_unique_id)"
+        )
+        await conn.execute(
             """
             CREATE TABLE IF NOT EXISTS user_settings (
                 user_id INTEGER PRIMARY KEY,
@@ -31,55 +161,247 @@ async def init_db():
             )
             """
         )
-        await db.commit()
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS fsm_states (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                expires_at REAL
+            )
+            """
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires_at ON fsm_states (expires_at)")
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'queued',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                available_at REAL,
+                last_error TEXT,
+                created_at REAL,
+                updated_at REAL
+            )
+            """
+        )
+        await conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_available_at ON jobs (status, available_at)")
 
-async def get_user_packs(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT * FROM packs WHERE user_id = ?", (user_id,)) as cursor:
-            return await cursor.fetchall()
+        columns = ", ".join(f"{metric} INTEGER NOT NULL DEFAULT 0" for metric in STATS_METRICS)
+        async with conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'") as cursor:
+            backfill = await cursor.fetchone() is None
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS user_stats (user_id INTEGER PRIMARY KEY, {columns}, updated_at REAL)")
+        await conn.execute("CREATE TABLE IF NOT EXISTS global_stats (metric TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT,
+                metric TEXT,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (day, metric)
+            )
+            """
+        )
+        # Only there to count each user once per day in daily_stats.active_users
+        await conn.execute("CREATE TABLE IF NOT EXISTS daily_users (day TEXT, user_id INTEGER, PRIMARY KEY (day, user_id))")
+        if backfill:
+            # Existing installs start from what the raw tables hold today
+            await conn.execute(
+                """
+                INSERT INTO user_stats (user_id, packs_created, stickers_added, updated_at)
+                SELECT p.user_id, COUNT(DISTINCT p.id), COUNT(s.id), ?
+                FROM packs p LEFT JOIN stickers s ON s.pack_id = p.id
+                GROUP BY p.user_id
+                """,
+                (time.time(),),
+            )
+            await conn.execute(
+                """
+                INSERT INTO global_stats (metric, value)
+                SELECT 'packs_created', COALESCE(SUM(packs_created), 0) FROM user_stats
+                UNION ALL
+                SELECT 'stickers_added', COALESCE(SUM(stickers_added), 0) FROM user_stats
+                """
+            )
+
+async def get_user_packs_page(user_id: int, page: int, page_size: int):
+    # ([(id, title, pack_type)], total, page); a page past the end falls back to the last one
+    query = """
+        SELECT id, title, pack_type, COUNT(*) OVER ()
+        FROM packs WHERE user_id = ?
+        ORDER BY id LIMIT ? OFFSET ?
+    """
+    rows = await db.fetchall(query, (user_id, page_size, page * page_size))
+    if not rows and page > 0:
+        total = (await db.fetchone("SELECT COUNT(*) FROM packs WHERE user_id = ?", (user_id,)))[0]
+        page = max(0, (total - 1) // page_size)
+        rows = await db.fetchall(query, (user_id, page_size, page * page_size))
+    total = rows[0][3] if rows else 0
+    return [row[:3] for row in rows], total, page
+
+async def get_pack_page(user_id: int, pack_id: int, page_size: int) -> int:
+    # Which page of the pack list a pack is on; walks idx_packs_user_id only
+    row = await db.fetchone("SELECT COUNT(*) FROM packs WHERE user_id = ? AND id < ?", (user_id, pack_id))
+    return row[0] // page_size
 
 async def get_user_current_pack_id(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT current_pack_id FROM user_settings WHERE user_id = ?", (user_id,)) as cursor:
-            setting = await cursor.fetchone()
-            return setting[0] if setting else None
+    setting = await db.fetchone("SELECT current_pack_id FROM user_settings WHERE user_id = ?", (user_id,))
+    return setting[0] if setting else None
+
+async def get_user_current_pack(user_id: int):
+    # (current_pack_id, name, title, pack_type, sticker_count); name is None if the pack row is gone
+    return await db.fetchone(
+        """
+        SELECT s.current_pack_id, p.name, p.title, p.pack_type,
+               (SELECT COUNT(*) FROM stickers WHERE pack_id = s.current_pack_id)
+        FROM user_settings s
+        LEFT JOIN packs p ON p.id = s.current_pack_id
+        WHERE s.user_id = ?
+        """,
+        (user_id,),
+    )
 
 async def set_user_current_pack_id(user_id: int, pack_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO user_settings (user_id, current_pack_id) VALUES (?, ?)",
-            (user_id, pack_id),
-        )
-        await db.commit()
+    await db.execute(
+        "INSERT OR REPLACE INTO user_settings (user_id, current_pack_id) VALUES (?, ?)",
+        (user_id, pack_id),
+    )
 
-async def create_pack(user_id: int, name: str, title: str, pack_type: str):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute(
+async def create_pack(user_id: int, name: str, title: str, pack_type: str, select: bool = False):
+    async with db.transaction() as conn:
+        cursor = await conn.execute(
             "INSERT INTO packs (user_id, name, title, pack_type) VALUES (?, ?, ?, ?)",
             (user_id, name, title, pack_type)
         )
-        await db.commit()
-        
-        async with db.execute("SELECT id FROM packs WHERE name = ?", (name,)) as cursor:
-            new_pack = await cursor.fetchone()
-            return new_pack[0]
-
-async def delete_pack_from_db(pack_id: int, user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        await db.execute("DELETE FROM packs WHERE id = ?", (pack_id,))
-        async with db.execute("SELECT current_pack_id FROM user_settings WHERE user_id = ?", (user_id,)) as cursor:
-             setting = await cursor.fetchone()
-             if setting and setting[0] == pack_id:
-                 await db.execute("DELETE FROM user_settings WHERE user_id = ?", (user_id,))
-        await db.commit()
+        pack_id = cursor.lastrowid
+        if select:
+            await conn.execute(
+                "INSERT OR REPLACE INTO user_settings (user_id, current_pack_id) VALUES (?, ?)",
+                (user_id, pack_id),
+            )
+        return pack_id
+
+async def delete_pack_from_db(pack_id: int, user_id: int) -> int:
+    # Returns how many mirrored stickers went with the pack
+    async with db.transaction() as conn:
+        await conn.execute("DELETE FROM packs WHERE id = ?", (pack_id,))
+        cursor = await conn.execute("DELETE FROM stickers WHERE pack_id = ?", (pack_id,))
+        await conn.execute(
+            "DELETE FROM user_settings WHERE user_id = ? AND current_pack_id = ?",
+            (user_id, pack_id),
+        )
+    return cursor.rowcount
 
 async def get_pack_by_id(pack_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT name, title, pack_type FROM packs WHERE id = ?", (pack_id,)) as cursor:
-            return await cursor.fetchone()
+    # Same shape as get_user_current_pack: (id, name, title, pack_type, sticker_count)
+    return await db.fetchone(
+        """
+        SELECT p.id, p.name, p.title, p.pack_type, (SELECT COUNT(*) FROM stickers WHERE pack_id = p.id)
+        FROM packs p
+        WHERE p.id = ?
+        """,
+        (pack_id,),
+    )
+
+async def get_user_pack_by_name(user_id: int, name: str):
+    return await db.fetchone(
+        "SELECT id, name, title, pack_type FROM packs WHERE name = ? AND user_id = ?",
+        (name, user_id),
+    )
+
+async def add_pack_stickers(pack_id: int, emojis: Iterable[str]):
+    now = time.time()
+    await db.executemany(
+        "INSERT INTO stickers (pack_id, emoji, created_at) VALUES (?, ?, ?)",
+        [(pack_id, emoji, now) for emoji in emojis],
+    )
+
+async def replace_pack_stickers(pack_id: int, stickers: Iterable[Iterable]):
+    # stickers: (file_id, file_unique_id, emoji) in set order
+    now = time.time()
+    async with db.transaction() as conn:
+        await conn.execute("DELETE FROM stickers WHERE pack_id = ?", (pack_id,))
+        await conn.executemany(
+            """
+            INSERT INTO stickers (pack_id, file_id, file_unique_id, emoji, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            [(pack_id, file_id, file_unique_id, emoji, now) for file_id, file_unique_id, emoji in stickers],
+        )
+        await conn.execute("UPDATE packs SET synced_at = ? WHERE id = ?", (now, pack_id))
+
+async def get_sticker_by_unique_id(pack_id: int, file_unique_id: str):
+    return await db.fetchone(
+        "SELECT id, file_id FROM stickers WHERE pack_id = ? AND file_unique_id = ?",
+        (pack_id, file_unique_id),
+    )
+
+async def set_sticker_file_id(sticker_id: int, file_id: str):
+    await db.execute("UPDATE stickers SET file_id = ? WHERE id = ?", (file_id, sticker_id))
+
+async def get_user_sticker(sticker_id: int, user_id: int):
+    # (file_id, pack_id) if the sticker is in one of the user's packs
+    return await db.fetchone(
+        """
+        SELECT s.file_id, s.pack_id
+        FROM stickers s
+        JOIN packs p ON p.id = s.pack_id
+        WHERE s.id = ? AND p.user_id = ?
+        """,
+        (sticker_id, user_id),
+    )
+
+async def delete_sticker_from_db(sticker_id: int):
+    await db.execute("DELETE FROM stickers WHERE id = ?", (sticker_id,))
 
 async def get_user_stats(user_id: int):
-    async with aiosqlite.connect(DB_NAME) as db:
-        async with db.execute("SELECT COUNT(*) FROM packs WHERE user_id = ?", (user_id,)) as cursor:
-            count = await cursor.fetchone()
-            return count[0] if count else 0
+    # {metric: value} from the counters; one primary key lookup
+    row = await db.fetchone(f"SELECT {', '.join(STATS_METRICS)} FROM user_stats WHERE user_id = ?", (user_id,))
+    return dict(zip(STATS_METRICS, row or (0,) * len(STATS_METRICS)))
+
+async def get_global_stats():
+    return dict(await db.fetchall("SELECT metric, value FROM global_stats"))
+
+async def get_daily_stats(since: str):
+    # [(day, metric, value)] for days >= since (YYYY-MM-DD)
+    return await db.fetchall("SELECT day, metric, value FROM daily_stats WHERE day >= ? ORDER BY day", (since,))
+
+async def flush_stats(users, totals, daily, active):
+    """Applies buffered counter deltas in one transaction.
+
+    users: {user_id: {metric: delta}}, totals: {metric: delta},
+    daily: {(day, metric): delta}, active: {(day, user_id)}.
+    """
+    now = time.time()
+    columns = ", ".join(STATS_METRICS)
+    updates = ", ".join(f"{metric} = {metric} + excluded.{metric}" for metric in STATS_METRICS)
+    async with db.transaction() as conn:
+        await conn.executemany(
+            f"""
+            INSERT INTO user_stats (user_id, {columns}, updated_at)
+            VALUES (?, {", ".join("?" * len(STATS_METRICS))}, ?)
+            ON CONFLICT (user_id) DO UPDATE SET {updates}, updated_at = excluded.updated_at
+            """,
+            [(user_id, *(deltas.get(metric, 0) for metric in STATS_METRICS), now) for user_id, deltas in users.items()],
+        )
+        await conn.executemany(
+            "INSERT INTO global_stats (metric, value) VALUES (?, ?) ON CONFLICT (metric) DO UPDATE SET value = value + excluded.value",
+            list(totals.items()),
+        )
+        new_active = Counter()
+        for day, user_id in active:
+            cursor = await conn.execute("INSERT OR IGNORE INTO daily_users (day, user_id) VALUES (?, ?)", (day, user_id))
+            new_active[day] += cursor.rowcount
+        rows = [(day, metric, value) for (day, metric), value in daily.items()]
+        rows += [(day, "active_users", count) for day, count in new_active.items() if count]
+        await conn.executemany(
+            "INSERT INTO daily_stats (day, metric, value) VALUES (?, ?, ?) ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value",
+            rows,
+        )
+        if active:
+            # Days older than anything still being buffered are finished
+            await conn.execute("DELETE FROM daily_users WHERE day < ?", (min(day for day, _ in active),))
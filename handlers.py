@@ -1,8 +1,8 @@
 import logging
 import time
 import asyncio
-from io import BytesIO
-from typing import List
+from functools import partial
+from typing import List, NamedTuple
 
 from aiogram import Router, F
 from aiogram.filters import Command
@@ -10,31 +10,49 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import (
     Message,
     CallbackQuery,
-    BufferedInputFile,
+    ChatMemberUpdated,
     InputSticker
 )
-from aiogram.exceptions import TelegramRetryAfter
 
-from loader import bot
+from loader import bot, job_queue, media_engine, pack_menus, stats, sticker_cache, subscription_cache
+from jobqueue import Job, LeaseLost
+from media import MediaQueueFull, MediaJobTimeout
+from albums import MediaGroupAggregator
+from importer import import_archive, is_archive
+from sticker_sets import (
+    MediaTooLarge,
+    SetFiller,
+    download_media,
+    encode_media,
+    make_input_sticker,
+    remember_sticker,
+    room_left,
+    sticker_variant,
+    upload_sticker,
+)
+from middlewares import UNSUBSCRIBED_STATUSES
+from config import ADMIN_IDS, JOB_QUEUE, MEDIA_GROUP_DELAY, MEDIA_MAX_INPUT_BYTES, PACKS_PAGE_SIZE
 from states import StickerStates
 from database import (
-    get_user_packs,
+    get_user_packs_page,
+    get_pack_page,
     get_user_current_pack_id,
+    get_user_current_pack,
     set_user_current_pack_id,
     create_pack,
     delete_pack_from_db,
-    get_pack_by_id,
-    get_user_stats
+    get_user_pack_by_name,
+    get_user_sticker,
+    delete_sticker_from_db,
+    get_pack_by_id
 )
 from keyboards import (
     get_main_keyboard, 
     get_pack_type_keyboard,
     get_delete_sticker_keyboard
 )
-from utils import process_image, process_video
 
 router = Router()
-media_group_lock = asyncio.Lock()
 
 @router.callback_query(F.data == "check_subscription")
 async def cb_check_subscription(callback: CallbackQuery):
@@ -45,8 +63,9 @@ async def cb_check_subscription(callback: CallbackQuery):
         return
 
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=callback.from_user.id)
-        if member.status not in ["left", "kicked", "banned"]:
+        # The user says they just subscribed, so a cached "no" must not stick
+        subscription_cache.invalidate(callback.from_user.id)
+        if await subscription_cache.is_subscribed(bot, CHANNEL_ID, callback.from_user.id):
             await callback.message.delete()
             await cmd_start(callback.message)
         else:
@@ -55,17 +74,43 @@ async def cb_check_subscription(callback: CallbackQuery):
         await callback.answer(f"Ошибка проверки: {e}", show_alert=True)
 
 
-@router.message(Command("start"))
-async def cmd_start(message: Message):
-    user_id = message.from_user.id
-    packs = await get_user_packs(user_id)
-    current_pack_id = await get_user_current_pack_id(user_id)
+@router.chat_member()
+async def on_channel_member_update(update: ChatMemberUpdated):
+    # Needs the bot to be a channel admin; keeps the subscription cache exact
+    from config import CHANNEL_ID
 
+    if not CHANNEL_ID:
+        return
+    chat = update.chat
+    if CHANNEL_ID not in (str(chat.id), f"@{chat.username}"):
+        return
+    subscribed = update.new_chat_member.status not in UNSUBSCRIBED_STATUSES
+    subscription_cache.set(update.new_chat_member.user.id, subscribed)
+
+
+async def pack_menu(user_id: int, current_pack_id: int | None, page: int | None = None):
+    # Without a current pack the first one on the page gets selected
+    if page is None:
+        page = await get_pack_page(user_id, current_pack_id, PACKS_PAGE_SIZE) if current_pack_id else 0
+    keyboard = pack_menus.get(user_id, page, current_pack_id)
+    if keyboard:
+        return keyboard
+
+    packs, total, page = await get_user_packs_page(user_id, page, PACKS_PAGE_SIZE)
     if not current_pack_id and packs:
         current_pack_id = packs[0][0]
         await set_user_current_pack_id(user_id, current_pack_id)
+    keyboard = get_main_keyboard(packs, current_pack_id, page, total, PACKS_PAGE_SIZE)
+    pack_menus.put(user_id, page, current_pack_id, keyboard)
+    return keyboard
+
 
-    keyboard = get_main_keyboard(packs, current_pack_id)
+@router.message(Command("start"))
+async def cmd_start(message: Message):
+    user_id = message.from_user.id
+    current_pack_id = await get_user_current_pack_id(user_id)
+
+    keyboard = await pack_menu(user_id, current_pack_id)
     await message.answer(
         "Здарова я могу стикерпак сделать типа из картинок\n\n кидай картинку (или видео для видео-стикера)",
         reply_markup=keyboard,
@@ -96,17 +141,17 @@ async def process_pack_type(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     title = data['title']
     user_id = callback.from_user.id
-    bot_info = await bot.get_me()
+    # Cached by aiogram after the first call, which the startup warm-up makes
+    bot_info = await bot.me()
     
     suffix = int(time.time())
     name = f"stickers_{user_id}_{suffix}_by_{bot_info.username}"
     
-    new_pack_id = await create_pack(user_id, name, title, pack_type)
-    await set_user_current_pack_id(user_id, new_pack_id)
-    
-    packs = await get_user_packs(user_id)
+    new_pack_id = await create_pack(user_id, name, title, pack_type, select=True)
+    stats.record(user_id, packs_created=1)
+    pack_menus.invalidate(user_id)
 
-    keyboard = get_main_keyboard(packs, new_pack_id)
+    keyboard = await pack_menu(user_id, new_pack_id)
     type_text = "стикерпак" if pack_type == "regular" else "эмодзи пак"
     await callback.message.answer(
         f"Пак '{title}' ({type_text}) создан, теперь кидай картинку",
@@ -118,13 +163,16 @@ async def process_pack_type(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.startswith("select_"))
 async def cb_select_pack(callback: CallbackQuery):
-    pack_id = int(callback.data.split("_")[1])
+    # select_<pack_id>_<page>; menus sent before paging have no page
+    parts = callback.data.split("_")
+    pack_id = int(parts[1])
+    page = int(parts[2]) if len(parts) > 2 else None
     user_id = callback.from_user.id
     
     await set_user_current_pack_id(user_id, pack_id)
-    packs = await get_user_packs(user_id)
-            
-    keyboard = get_main_keyboard(packs, pack_id)
+    pack_menus.invalidate(user_id)
+
+    keyboard = await pack_menu(user_id, pack_id, page)
     try:
         await callback.message.edit_reply_markup(reply_markup=keyboard)
     except Exception:
@@ -138,15 +186,11 @@ async def cb_delete_pack(callback: CallbackQuery):
     current_pack_id = await get_user_current_pack_id(user_id)
             
     if current_pack_id:
-        await delete_pack_from_db(current_pack_id, user_id)
-            
-    packs = await get_user_packs(user_id)
-            
-    new_current_id = packs[0][0] if packs else None
-    if new_current_id:
-        await set_user_current_pack_id(user_id, new_current_id)
-            
-    keyboard = get_main_keyboard(packs, new_current_id)
+        sticker_count = await delete_pack_from_db(current_pack_id, user_id)
+        stats.record(user_id, packs_deleted=1, stickers_deleted=sticker_count)
+    pack_menus.invalidate(user_id)
+
+    keyboard = await pack_menu(user_id, None)
     await callback.message.edit_text(
         "Пак удален из списка (в телеграме он остался, если там были стикеры). Выбери другой или создай новый.",
         reply_markup=keyboard
@@ -154,27 +198,93 @@ async def cb_delete_pack(callback: CallbackQuery):
     await callback.answer()
 
 
+@router.callback_query(F.data.startswith("packs_page_"))
+async def cb_packs_page(callback: CallbackQuery):
+    page = int(callback.data.replace("packs_page_", ""))
+    user_id = callback.from_user.id
+    current_pack_id = await get_user_current_pack_id(user_id)
+
+    keyboard = await pack_menu(user_id, current_pack_id, page)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=keyboard)
+    except Exception:
+        pass
+    await callback.answer()
+
+
+@router.callback_query(F.data == "noop")
+async def cb_noop(callback: CallbackQuery):
+    await callback.answer()
+
+
 @router.callback_query(F.data == "stats")
 async def cb_stats(callback: CallbackQuery):
-    user_id = callback.from_user.id
-    pack_count = await get_user_stats(user_id)
-    await callback.answer(f"У тебя {pack_count} паков в базе бота.", show_alert=True)
+    await callback.answer(await user_stats_text(callback.from_user.id), show_alert=True)
+
+
+@router.message(Command("stats"))
+async def cmd_stats(message: Message):
+    await message.answer(await user_stats_text(message.from_user.id))
+
+
+async def user_stats_text(user_id: int) -> str:
+    counters = await stats.user(user_id)
+    pack_count = counters["packs_created"] - counters["packs_deleted"]
+    sticker_count = counters["stickers_added"] - counters["stickers_deleted"]
+    return f"У тебя {pack_count} паков и {sticker_count} стикеров в базе бота."
+
+
+@router.message(Command("admin_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_admin_stats(message: Message):
+    totals = await stats.totals()
+    lines = [
+        "Всего:",
+        f"паков {totals['packs_created'] - totals['packs_deleted']} (создано {totals['packs_created']}, удалено {totals['packs_deleted']})",
+        f"стикеров {totals['stickers_added'] - totals['stickers_deleted']} (добавлено {totals['stickers_added']}, удалено {totals['stickers_deleted']})",
+        f"скачано {totals['bytes_in'] / 1024 / 1024:.1f} МБ, отдано {totals['bytes_out'] / 1024 / 1024:.1f} МБ",
+        f"ошибок {totals['failures']}",
+        "",
+        "По дням (юзеры / паки / стикеры / ошибки):",
+    ]
+    for day, counters in await stats.daily(7):
+        lines.append(
+            f"{day}: {counters['active_users']} / {counters['packs_created']} / "
+            f"{counters['stickers_added']} / {counters['failures']}"
+        )
+    await message.answer("\n".join(lines))
 
 
 @router.message(F.sticker)
 async def handle_sticker_message(message: Message):
     user_id = message.from_user.id
     
-    if message.sticker.set_name and f"_{user_id}_" in message.sticker.set_name:
-        keyboard = get_delete_sticker_keyboard(message.sticker.file_id)
+    if not message.sticker.set_name:
+        return
+    pack = await get_user_pack_by_name(user_id, message.sticker.set_name)
+    if not pack:
+        return
+    sticker_id = await remember_sticker(pack[0], pack[1], message.sticker)
+    if sticker_id:
+        keyboard = get_delete_sticker_keyboard(sticker_id)
         await message.reply("Хочешь удалить этот стикер из пака?", reply_markup=keyboard)
 
 
 @router.callback_query(F.data.startswith("del_sticker_"))
 async def cb_delete_sticker(callback: CallbackQuery):
-    file_id = callback.data.replace("del_sticker_", "")
+    sticker_id = callback.data.removeprefix("del_sticker_")
+    if not sticker_id.isdigit():
+        # Keyboards sent before the stickers table carried a file_id here
+        await callback.answer("Кнопка устарела, отправь стикер еще раз", show_alert=True)
+        return
+    sticker_id = int(sticker_id)
+    sticker = await get_user_sticker(sticker_id, callback.from_user.id)
+    if not sticker:
+        await callback.answer("Это не твой стикер или его уже нет", show_alert=True)
+        return
     try:
-        await bot.delete_sticker_from_set(file_id)
+        await bot.delete_sticker_from_set(sticker[0])
+        await delete_sticker_from_db(sticker_id)
+        stats.record(callback.from_user.id, stickers_deleted=1)
         await callback.message.edit_text("Стикер удален")
     except Exception as e:
         await callback.message.edit_text(f"Ошибка удаления: {e}")
@@ -187,101 +297,308 @@ async def cb_cancel_delete(callback: CallbackQuery):
     await callback.answer()
 
 
-async def process_media_item(message: Message, user_id: int):
-    current_pack_id = await get_user_current_pack_id(user_id)
-            
-    if not current_pack_id:
-        await message.answer("Cначала выбери или создай пак\n\n Нажми кнопку выше.")
-        return
-            
-    pack_data = await get_pack_by_id(current_pack_id)
-    if not pack_data:
-        await message.answer("Чет не могу найти этот пак, выбери другой")
-        return
-    pack_name, pack_title, pack_type = pack_data
+class MediaError(Exception):
+    pass
 
-    file_id = None
-    is_video = False
-    
+
+class MediaBusy(MediaError):
+    # The engine was overloaded or too slow; a queued job can try again later
+    pass
+
+
+class MediaItem(NamedTuple):
+    file_id: str
+    file_unique_id: str
+    file_size: int | None
+    is_video: bool
+
+
+class PreparedSticker(NamedTuple):
+    sticker: InputSticker
+    # Built from a file_id cached by an earlier upload, which Telegram may reject by now
+    cached: bool
+
+
+def extract_media(message: Message) -> MediaItem | None:
+    media, is_video = None, False
     if message.photo:
-        file_id = message.photo[-1].file_id
+        media = message.photo[-1]
     elif message.video:
-        file_id = message.video.file_id
-        is_video = True
-    elif message.document:
+        media, is_video = message.video, True
+    elif message.document and message.document.mime_type:
         if message.document.mime_type.startswith("image/"):
-            file_id = message.document.file_id
+            media = message.document
         elif message.document.mime_type.startswith("video/"):
-            file_id = message.document.file_id
-            is_video = True
+            media, is_video = message.document, True
+    if media is None:
+        return None
+    return MediaItem(media.file_id, media.file_unique_id, media.file_size, is_video)
+
+
+async def get_current_pack(message: Message, user_id: int):
+    current_pack = await get_user_current_pack(user_id)
             
-    if not file_id:
-        await message.answer("Отправь картинку или видео")
-        return
+    if not current_pack or not current_pack[0]:
+        await message.answer("Cначала выбери или создай пак\n\n Нажми кнопку выше.")
+        return None
+            
+    if current_pack[1] is None:
+        await message.answer("Чет не могу найти этот пак, выбери другой")
+        return None
+    return current_pack
+
+
+async def prepare_sticker(user_id: int, media: MediaItem | None, is_emoji: bool) -> PreparedSticker:
+    if not media:
+        raise MediaError("Отправь картинку или видео")
+    if media.file_size and media.file_size > MEDIA_MAX_INPUT_BYTES:
+        raise MediaError(f"Файл слишком большой, максимум {MEDIA_MAX_INPUT_BYTES // (1024 * 1024)} МБ")
+
+    is_video = media.is_video
+    if is_video and media_engine.video_available is False:
+        raise MediaError("Видео сейчас не принимаю, попробуй картинку")
+    variant = sticker_variant(is_video, is_emoji)
+    cache_key = sticker_cache.key(media.file_unique_id, variant)
+    uploaded = sticker_cache.get_file_id(user_id, cache_key)
+    if uploaded:
+        file_id, sticker_format = uploaded
+        return PreparedSticker(make_input_sticker(file_id, sticker_format == "video"), cached=True)
+
+    processed_data = await sticker_cache.get(cache_key)
+    if processed_data is None:
+        try:
+            processed_data = await download_and_process(media.file_id, is_video, is_emoji)
+        except MediaError:
+            stats.record(user_id, failures=1)
+            raise
+        stats.record(user_id, bytes_in=media.file_size or 0, bytes_out=len(processed_data))
+        await sticker_cache.put(cache_key, processed_data)
+
+    try:
+        input_sticker = await upload_sticker(user_id, processed_data, is_video)
+    except Exception as e:
+        logging.error(f"Error uploading sticker file: {e}")
+        stats.record(user_id, failures=1)
+        raise MediaError(f"Не удалось загрузить стикер: {e}")
+    sticker_cache.put_file_id(user_id, cache_key, input_sticker.sticker, input_sticker.format)
+    return PreparedSticker(input_sticker, cached=False)
 
+
+def reupload(user_id: int, media: MediaItem, is_emoji: bool, prepared: PreparedSticker):
+    # Lets SetFiller retry once with a fresh upload if the cached file_id is refused
+    if not prepared.cached:
+        return None
+
+    async def retry() -> InputSticker:
+        variant = sticker_variant(media.is_video, is_emoji)
+        sticker_cache.drop_file_id(user_id, sticker_cache.key(media.file_unique_id, variant))
+        return (await prepare_sticker(user_id, media, is_emoji)).sticker
+
+    return retry
+
+
+async def download_and_process(file_id: str, is_video: bool, is_emoji: bool) -> bytes | bytearray:
     file = await bot.get_file(file_id)
-    file_data = BytesIO()
-    await bot.download_file(file.file_path, file_data)
-    
-    is_emoji = pack_type == "custom_emoji"
-    
     try:
-        if is_video:
-            processed_data = process_video(file_data)
-            filename = "sticker.webm"
-            fmt = "video"
-        else:
-            processed_data = process_image(file_data, is_emoji=is_emoji)
-            filename = "sticker.png"
-            fmt = "static"
+        async with download_media(file) as source:
+            return await encode_media(source, is_video, is_emoji)
+    except MediaTooLarge:
+        raise MediaError(f"Файл слишком большой, максимум {MEDIA_MAX_INPUT_BYTES // (1024 * 1024)} МБ")
+    except MediaQueueFull as e:
+        raise MediaBusy(f"Очередь забита, попробуй через {e.retry_after} сек")
+    except MediaJobTimeout:
+        raise MediaBusy("Слишком долго обрабатывал, попробуй файл поменьше")
     except Exception as e:
         logging.error(f"Error processing media: {e}")
-        await message.answer(f"Ошибка обработки: {e}")
+        raise MediaError(f"Ошибка обработки: {e}")
+
+
+async def process_media_item(message: Message, user_id: int):
+    pack = await get_current_pack(message, user_id)
+    if not pack:
         return
+    item = extract_media(message)
+    if JOB_QUEUE != "off":
+        await enqueue_stickers(message, user_id, pack, [item])
+        return
+    await add_media_item(user_id, pack, item, message.answer)
 
-    sticker_file = BufferedInputFile(processed_data.read(), filename=filename)
-    input_sticker = InputSticker(
-        sticker=sticker_file,
-        format=fmt,
-        emoji_list=["😀"]
-    )
 
+async def process_media_group(messages: List[Message]):
+    first = messages[0]
+    user_id = first.from_user.id
+    pack = await get_current_pack(first, user_id)
+    if not pack:
+        return
+    items = [extract_media(message) for message in messages]
+    if JOB_QUEUE != "off":
+        await enqueue_stickers(first, user_id, pack, items)
+        return
+    await add_media_group(user_id, pack, items, first.answer)
+
+
+async def add_media_item(user_id: int, pack, item: MediaItem | None, reply, on_done=None, retry_busy=False):
+    # With retry_busy, MediaBusy is raised instead of replied so the job queue retries later
+    pack_id, pack_name, pack_title, pack_type, sticker_count = pack
+    if await room_left(pack) <= 0:
+        await reply("Пак заполнен, создай новый")
+        return
+
+    is_emoji = pack_type == "custom_emoji"
     try:
-        try:
-            await bot.add_sticker_to_set(
-                user_id=user_id,
-                name=pack_name,
-                sticker=input_sticker
-            )
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-            await bot.add_sticker_to_set(
-                user_id=user_id,
-                name=pack_name,
-                sticker=input_sticker
-            )
-            
-        if not message.media_group_id:
-            await message.answer(f"Готово, добавил в пак.\nhttps://t.me/addstickers/{pack_name}")
+        prepared = await prepare_sticker(user_id, item, is_emoji=is_emoji)
+    except MediaError as e:
+        if retry_busy and isinstance(e, MediaBusy):
+            raise
+        await reply(str(e))
+        return
+
+    # An empty mirror usually means the set was never created, so go straight to creating it
+    filler = SetFiller(user_id, pack, exists=sticker_count > 0)
+    try:
+        await filler.push(prepared.sticker, on_done=on_done, reupload=reupload(user_id, item, is_emoji, prepared))
+        await filler.close()
+    except LeaseLost:
+        raise
     except Exception as e:
-        if "STICKERSET_INVALID" in str(e) or "set not found" in str(e).lower():
+        logging.error(f"Error creating sticker set: {e}")
+        await reply(f"Не удалось создать пак: {e}")
+        return
+
+    if filler.errors:
+        await reply(filler.errors[0])
+    elif filler.created:
+        await reply(f"Создал новый пак и добавил туда стикер\nСсылка: https://t.me/addstickers/{pack_name}")
+    else:
+        await reply(f"Готово, добавил в пак.\nhttps://t.me/addstickers/{pack_name}")
+
+
+async def add_media_group(
+    user_id: int, pack, items: List[MediaItem | None], reply, done=(), on_done=None, retry_busy=False
+):
+    # `done` holds indexes settled by an earlier attempt of the same job;
+    # on_done(index) is called as each remaining one settles. With retry_busy,
+    # items hit by MediaBusy stay unsettled and the error is raised at the end
+    # so the job queue retries just those
+    pack_id, pack_name, pack_title, pack_type, sticker_count = pack
+    is_emoji = pack_type == "custom_emoji"
+
+    room = await room_left(pack)
+    if room <= 0:
+        await reply("Пак заполнен, создай новый")
+        return
+    errors = []
+    todo = [index for index in range(len(items)) if index not in done]
+    if len(todo) > room:
+        errors.append(f"В пак влезет еще только {room}, остальные пропустил")
+        todo = todo[:room]
+
+    def settled(index: int):
+        return (lambda: on_done(index)) if on_done else None
+
+    # Every item downloads, encodes and uploads concurrently; the set is
+    # filled in album order as soon as each one is ready
+    tasks = [asyncio.create_task(prepare_sticker(user_id, items[index], is_emoji=is_emoji)) for index in todo]
+    filler = SetFiller(user_id, pack, exists=sticker_count > 0)
+    busy = None
+    try:
+        for index, task in zip(todo, tasks):
             try:
-                sticker_type = "custom_emoji" if is_emoji else "regular"
-                await bot.create_new_sticker_set(
-                    user_id=user_id,
-                    name=pack_name,
-                    title=pack_title,
-                    stickers=[input_sticker],
-                    sticker_format=fmt,
-                    sticker_type=sticker_type,
+                prepared = await task
+            except MediaBusy as e:
+                if retry_busy:
+                    busy = e
+                    continue
+                errors.append(str(e))
+            except MediaError as e:
+                errors.append(str(e))
+            except Exception as e:
+                logging.error(f"Error preparing album item: {e}")
+                errors.append(f"Ошибка обработки: {e}")
+            else:
+                await filler.push(
+                    prepared.sticker,
+                    on_done=settled(index),
+                    reupload=reupload(user_id, items[index], is_emoji, prepared),
                 )
-                await message.answer(f"Создал новый пак и добавил туда стикер\nСсылка: https://t.me/addstickers/{pack_name}")
-            except Exception as create_e:
-                logging.error(f"Error creating sticker set: {create_e}")
-                await message.answer(f"Не удалось создать пак: {create_e}")
-        else:
-            logging.error(f"Error adding sticker: {e}")
-            await message.answer(f"Не удалось добавить стикер: {e}")
+                continue
+            if on_done:
+                await on_done(index)
+        await filler.close()
+    except LeaseLost:
+        raise
+    except Exception as e:
+        logging.error(f"Error creating sticker set: {e}")
+        errors.append(f"Не удалось создать пак: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    if busy:
+        raise busy
+    errors.extend(filler.errors)
+
+    text = f"Добавил {filler.added} из {len(items)} в пак.\nhttps://t.me/addstickers/{pack_name}"
+    if filler.created:
+        text = f"Создал новый пак. {text}"
+    if errors:
+        text += "\n\nНе получилось:\n" + "\n".join(f"• {error}" for error in dict.fromkeys(errors))
+    await reply(text)
+
+
+async def enqueue_stickers(message: Message, user_id: int, pack, items: List[MediaItem | None]):
+    await job_queue.enqueue(
+        "stickers",
+        {
+            "user_id": user_id,
+            "chat_id": message.chat.id,
+            "pack_id": pack[0],
+            "items": items,
+            "done": [],
+        },
+    )
+
+
+async def run_sticker_job(job: Job):
+    payload = job.payload
+    reply = partial(bot.send_message, payload["chat_id"])
+    pack = await get_pack_by_id(payload["pack_id"])
+    if not pack:
+        await reply("Пак удалили, пока я работал")
+        return
+
+    items = [MediaItem(*item) if item else None for item in payload["items"]]
+    done = set(payload["done"])
+
+    # The last attempt reports a busy engine to the user instead of failing silently
+    retry_busy = job.attempts < job.queue.max_attempts
+
+    async def checkpoint(index: int):
+        done.add(index)
+        payload["done"] = sorted(done)
+        await job.checkpoint()
+
+    if len(items) == 1:
+        if not done:
+            await add_media_item(
+                payload["user_id"], pack, items[0], reply, on_done=lambda: checkpoint(0), retry_busy=retry_busy
+            )
+        return
+    await add_media_group(
+        payload["user_id"], pack, items, reply, done=done, on_done=checkpoint, retry_busy=retry_busy
+    )
+
+
+media_groups = MediaGroupAggregator(process_media_group, delay=MEDIA_GROUP_DELAY)
+
+
+@router.message(F.document.func(is_archive))
+async def handle_archive(message: Message):
+    user_id = message.from_user.id
+    pack = await get_current_pack(message, user_id)
+    if not pack:
+        return
+    await import_archive(message, user_id, pack, message.document)
 
 
 @router.message(F.photo | F.document | F.video)
@@ -289,8 +606,6 @@ async def handle_media(message: Message):
     user_id = message.from_user.id
     
     if message.media_group_id:
-        async with media_group_lock:
-            await process_media_item(message, user_id)
-            await asyncio.sleep(1)
+        media_groups.add(message)
     else:
         await process_media_item(message, user_id)
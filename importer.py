@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import os
+import tarfile
+import tempfile
+import time
+import zipfile
+from typing import IO, Iterator, List, Tuple
+
+from aiogram.types import Document, Message
+
+from config import IMPORT_CONCURRENCY, IMPORT_MAX_ENTRY_BYTES, IMPORT_UPLOAD_CONCURRENCY
+from loader import bot, media_engine, stats
+from media import MediaJobTimeout, MediaQueueFull
+from metrics import DOWNLOAD_SECONDS
+from sticker_sets import (
+    CREATE_BATCH_SIZE,
+    SET_CAPACITY,
+    SetFiller,
+    encode_media,
+    reconcile_pack,
+    upload_sticker,
+)
+
+# getFile refuses anything bigger than this
+MAX_ARCHIVE_SIZE = 20 * 1024 * 1024
+ARCHIVE_MIME_TYPES = {
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/x-tar",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-bzip2",
+    "application/x-xz",
+}
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif"}
+VIDEO_EXTENSIONS = {".mp4", ".webm", ".mov", ".mkv"}
+PROGRESS_INTERVAL = 2.0
+# Archives up to this size stay in memory, bigger ones are spooled to disk
+SPOOL_SIZE = 2 * 1024 * 1024
+MAX_QUEUE_FULL_RETRIES = 5
+
+
+def is_archive(document: Document | None) -> bool:
+    # The router filter calls this for every message, documents or not
+    if document is None:
+        return False
+    name = (document.file_name or "").lower()
+    return document.mime_type in ARCHIVE_MIME_TYPES or name.endswith(ARCHIVE_EXTENSIONS)
+
+
+def _media_kind(name: str) -> bool | None:
+    # True for video, False for image, None for anything we don't import
+    base = os.path.basename(name)
+    if not base or base.startswith(".") or "__MACOSX" in name:
+        return None
+    ext = os.path.splitext(base)[1].lower()
+    if ext in VIDEO_EXTENSIONS:
+        return True
+    if ext in IMAGE_EXTENSIONS:
+        return False
+    return None
+
+
+def _read_capped(stream: IO[bytes], limit: int) -> bytes | None:
+    # Sizes in archive headers can lie, so never read more than limit + 1
+    data = stream.read(limit + 1)
+    return None if len(data) > limit else data
+
+
+def iter_archive(fileobj: IO[bytes], limit: int = IMPORT_MAX_ENTRY_BYTES) -> Iterator[Tuple[str, bool, bytes | None]]:
+    """Yield (name, is_video, data) for every media entry; data is None if the entry is too big."""
+    fileobj.seek(0)
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                is_video = _media_kind(info.filename)
+                if is_video is None:
+                    continue
+                if info.file_size > limit:
+                    yield info.filename, is_video, None
+                    continue
+                with archive.open(info) as entry:
+                    yield info.filename, is_video, _read_capped(entry, limit)
+        return
+
+    fileobj.seek(0)
+    # Stream mode reads members strictly in order without seeking back
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            is_video = _media_kind(member.name)
+            if is_video is None:
+                continue
+            if member.size > limit:
+                yield member.name, is_video, None
+                continue
+            yield member.name, is_video, _read_capped(archive.extractfile(member), limit)
+
+
+class ArchiveImport:
+    def __init__(self, message: Message, user_id: int, pack):
+        self.message = message
+        self.user_id = user_id
+        self.pack = pack
+        self.pack_id, self.pack_name, _, pack_type = pack[:4]
+        self.is_emoji = pack_type == "custom_emoji"
+        self.capacity = SET_CAPACITY.get(pack_type, SET_CAPACITY["regular"])
+        self.concurrency = max(1, IMPORT_CONCURRENCY)
+        # Entries go to the encoders through `_work`; `_slots` keeps one future
+        # per entry in archive order so the uploader can add them in that order
+        self._work: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self._slots: asyncio.Queue = asyncio.Queue(maxsize=CREATE_BATCH_SIZE + self.concurrency)
+        self._progress: Message | None = None
+        self._progress_at = 0.0
+        self._progress_text = ""
+        self.filler: SetFiller | None = None
+        self.found = 0
+        self.encoded = 0
+        self.skipped = 0
+        self.skipped_videos = 0
+        self.errors: List[str] = []
+
+    async def run(self, document: Document):
+        self._progress = await self.message.answer("Качаю архив...")
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as fileobj:
+            try:
+                file = await bot.get_file(document.file_id)
+                with DOWNLOAD_SECONDS.time():
+                    await bot.download_file(file.file_path, fileobj)
+            except Exception as e:
+                logging.error(f"Error downloading archive: {e}")
+                await self._report(f"Не смог скачать архив: {e}")
+                return
+
+            existing = await self._existing_count()
+            if existing is None:
+                return
+            room = self.capacity - existing
+            if room <= 0:
+                await self._report("Пак уже заполнен, больше не влезет")
+                return
+
+            await self._update_progress(force=True)
+            encoders = [asyncio.create_task(self._encode_worker()) for _ in range(self.concurrency)]
+            reader = asyncio.create_task(self._read_entries(fileobj, room))
+            try:
+                await self._upload()
+                await reader
+            except Exception as e:
+                logging.error(f"Archive import failed: {e}")
+                self.errors.append(f"Импорт прервался: {e}")
+            finally:
+                self.errors.extend(self.filler.errors)
+                reader.cancel()
+                for task in encoders:
+                    task.cancel()
+                await asyncio.gather(reader, *encoders, return_exceptions=True)
+
+        await self._report(self._summary())
+
+    async def _existing_count(self) -> int | None:
+        # One getStickerSet per job: tells whether the set exists and refreshes the mirror
+        try:
+            count = await reconcile_pack(self.pack_id, self.pack_name)
+        except Exception as e:
+            logging.error(f"Error fetching sticker set: {e}")
+            await self._report(f"Не смог проверить пак: {e}")
+            return None
+        self.filler = SetFiller(
+            self.user_id, self.pack, exists=count is not None, concurrency=IMPORT_UPLOAD_CONCURRENCY
+        )
+        return count or 0
+
+    async def _read_entries(self, fileobj: IO[bytes], room: int):
+        entries = iter_archive(fileobj)
+        try:
+            while True:
+                # Decompression is blocking, keep it off the event loop
+                entry = await asyncio.to_thread(next, entries, None)
+                if entry is None:
+                    break
+                name, is_video, data = entry
+                if is_video and media_engine.video_available is False:
+                    # No ffmpeg here; don't spend an encoder slot per file to learn that
+                    self.skipped_videos += 1
+                    continue
+                if self.found >= room:
+                    self.skipped += 1
+                    continue
+                self.found += 1
+                slot = asyncio.get_running_loop().create_future()
+                await self._slots.put(slot)
+                if data is None:
+                    slot.set_result((name, None, "файл слишком большой"))
+                    continue
+                await self._work.put((slot, name, is_video, data))
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            self.errors.append(f"Архив битый: {e}")
+        finally:
+            await self._slots.put(None)
+
+    async def _encode_worker(self):
+        while True:
+            slot, name, is_video, data = await self._work.get()
+            try:
+                encoded = await self._encode(data, is_video)
+                self.encoded += 1
+                stats.record(self.user_id, bytes_in=len(data), bytes_out=len(encoded))
+                slot.set_result((name, await upload_sticker(self.user_id, encoded, is_video), None))
+            except MediaJobTimeout:
+                stats.record(self.user_id, failures=1)
+                slot.set_result((name, None, "слишком долго обрабатывал"))
+            except Exception as e:
+                stats.record(self.user_id, failures=1)
+                slot.set_result((name, None, str(e)))
+
+    async def _encode(self, data: bytes, is_video: bool) -> bytes:
+        for _ in range(MAX_QUEUE_FULL_RETRIES):
+            try:
+                return await encode_media(data, is_video, self.is_emoji)
+            except MediaQueueFull as e:
+                # Other users share the engine; wait our turn instead of failing
+                await asyncio.sleep(e.retry_after)
+        return await encode_media(data, is_video, self.is_emoji)
+
+    async def _upload(self):
+        # Uploads already happened in the encoder stage, so the set calls
+        # below only carry file_ids
+        while (slot := await self._slots.get()) is not None:
+            name, sticker, error = await slot
+            if error:
+                self.errors.append(f"{name}: {error}")
+            else:
+                await self.filler.push(sticker, label=name)
+            await self._update_progress()
+        await self.filler.close()
+
+    def _summary(self) -> str:
+        text = f"Импорт готов: добавил {self.filler.added} из {self.found}.\nhttps://t.me/addstickers/{self.pack_name}"
+        if self.skipped:
+            text += f"\n\nНе влезло в пак: {self.skipped}"
+        if self.skipped_videos:
+            text += f"\n\nВидео сейчас не принимаю, пропустил: {self.skipped_videos}"
+        if self.errors:
+            shown = self.errors[:10]
+            text += "\n\nНе получилось:\n" + "\n".join(f"• {error}" for error in shown)
+            if len(self.errors) > len(shown):
+                text += f"\n...и еще {len(self.errors) - len(shown)}"
+        return text
+
+    async def _update_progress(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._progress_at < PROGRESS_INTERVAL:
+            return
+        self._progress_at = now
+        await self._report(
+            f"Импортирую... найдено {self.found}, обработано {self.encoded}, добавлено {self.filler.added}"
+        )
+
+    async def _report(self, text: str):
+        if text == self._progress_text:
+            return
+        self._progress_text = text
+        try:
+            await self._progress.edit_text(text)
+        except Exception:
+            # Progress is best effort; "message is not modified" and friends are fine
+            pass
+
+
+async def import_archive(message: Message, user_id: int, pack, document: Document):
+    if document.file_size and document.file_size > MAX_ARCHIVE_SIZE:
+        await message.answer("Архив больше 20 МБ, телеграм не даст его скачать. Разбей на части")
+        return
+    await ArchiveImport(message, user_id, pack).run(document)
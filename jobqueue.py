@@ -0,0 +1,241 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from database import Database
+
+JobHandler = Callable[["Job"], Awaitable[None]]
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, queue: "JobQueue", job_id: int, kind: str, payload: Dict[str, Any], attempts: int, owner: str):
+        self.queue = queue
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.owner = owner
+
+    async def checkpoint(self):
+        # Persist progress so a retry after a crash can skip finished work
+        if not await self.queue.update_payload(self.id, self.owner, self.payload):
+            raise LeaseLost(f"Lost the lease on job {self.id}")
+
+
+class JobQueue:
+    """Jobs stored in SQLite, handed out under time-limited leases.
+
+    A claimed job stays `running` while its owner keeps renewing the lease;
+    if the owner dies the lease runs out and any worker may claim it again,
+    so jobs are delivered at least once.
+    """
+
+    def __init__(self, database: Database, lease_seconds: float = 60, max_attempts: int = 5):
+        self.database = database
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        # Lets a worker in the same process pick up new jobs without waiting for its next poll
+        self.new_jobs = asyncio.Event()
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any], delay: float = 0) -> int:
+        now = time.time()
+        job_id = await self.database.execute(
+            """
+            INSERT INTO jobs (kind, payload, status, attempts, available_at, created_at, updated_at)
+            VALUES (?, ?, 'queued', 0, ?, ?, ?)
+            """,
+            (kind, json.dumps(payload, ensure_ascii=False), now + delay, now, now),
+        )
+        self.new_jobs.set()
+        return job_id
+
+    async def claim(self, owner: str) -> Job | None:
+        now = time.time()
+        # BEGIN IMMEDIATE makes select-then-update atomic across processes
+        async with self.database.transaction() as conn:
+            # A job whose worker keeps dying on it (OOM, kill) never gets to nack
+            # itself, so expired leases count against max_attempts here
+            await conn.execute(
+                """
+                UPDATE jobs SET status = 'failed', last_error = 'Lease expired too many times',
+                                lease_owner = NULL, updated_at = ?
+                WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?
+                """,
+                (now, now, self.max_attempts),
+            )
+            async with conn.execute(
+                """
+                SELECT id, kind, payload, attempts FROM jobs
+                WHERE (status = 'queued' AND available_at <= ?)
+                   OR (status = 'running' AND lease_expires_at < ? AND attempts < ?)
+                ORDER BY available_at, id
+                LIMIT 1
+                """,
+                (now, now, self.max_attempts),
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            job_id, kind, payload, attempts = row
+            await conn.execute(
+                """
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_owner = ?,
+                                lease_expires_at = ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (owner, now + self.lease_seconds, now, job_id),
+            )
+        return Job(self, job_id, kind, json.loads(payload), attempts + 1, owner)
+
+    async def _update_owned(self, sql: str, params: tuple) -> bool:
+        async with self.database.transaction() as conn:
+            cursor = await conn.execute(sql, params)
+            return cursor.rowcount > 0
+
+    async def heartbeat(self, job_id: int, owner: str) -> bool:
+        now = time.time()
+        return await self._update_owned(
+            "UPDATE jobs SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (now + self.lease_seconds, now, job_id, owner),
+        )
+
+    async def update_payload(self, job_id: int, owner: str, payload: Dict[str, Any]) -> bool:
+        return await self._update_owned(
+            "UPDATE jobs SET payload = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+            (json.dumps(payload, ensure_ascii=False), time.time(), job_id, owner),
+        )
+
+    async def ack(self, job_id: int, owner: str) -> bool:
+        return await self._update_owned(
+            "DELETE FROM jobs WHERE id = ? AND lease_owner = ? AND status = 'running'", (job_id, owner)
+        )
+
+    async def nack(self, job: Job, error: str) -> bool:
+        now = time.time()
+        if job.attempts >= self.max_attempts:
+            return await self._update_owned(
+                """
+                UPDATE jobs SET status = 'failed', last_error = ?, lease_owner = NULL, updated_at = ?
+                WHERE id = ? AND lease_owner = ?
+                """,
+                (error, now, job.id, job.owner),
+            )
+        # Exponential backoff with jitter, capped at ten minutes
+        delay = min(600, 2 ** job.attempts) * random.uniform(0.5, 1.0)
+        return await self._update_owned(
+            """
+            UPDATE jobs SET status = 'queued', available_at = ?, last_error = ?, lease_owner = NULL, updated_at = ?
+            WHERE id = ? AND lease_owner = ?
+            """,
+            (now + delay, error, now, job.id, job.owner),
+        )
+
+    async def release(self, job: Job) -> bool:
+        # Hands a job back untouched, e.g. on shutdown, without counting the attempt
+        now = time.time()
+        return await self._update_owned(
+            """
+            UPDATE jobs SET status = 'queued', attempts = attempts - 1, available_at = ?, lease_owner = NULL, updated_at = ?
+            WHERE id = ? AND lease_owner = ?
+            """,
+            (now, now, job.id, job.owner),
+        )
+
+    async def depth(self) -> Dict[str, int]:
+        rows = await self.database.fetchall("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return dict(rows)
+
+
+class JobWorker:
+    def __init__(
+        self,
+        queue: JobQueue,
+        handlers: Dict[str, JobHandler],
+        concurrency: int = 4,
+        poll_interval: float = 0.5,
+        owner: str | None = None,
+    ):
+        self.queue = queue
+        self.handlers = handlers
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._tasks: set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+
+    async def run(self):
+        idle = self.poll_interval
+        while not self._stopping.is_set():
+            await self._slots.acquire()
+            if self._stopping.is_set():
+                self._slots.release()
+                break
+            self.queue.new_jobs.clear()
+            try:
+                job = await self.queue.claim(self.owner)
+            except Exception as e:
+                logging.error(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                self._slots.release()
+                try:
+                    await asyncio.wait_for(self.queue.new_jobs.wait(), idle)
+                    idle = self.poll_interval
+                except asyncio.TimeoutError:
+                    # Back off while the queue stays empty
+                    idle = min(idle * 2, self.poll_interval * 8)
+                continue
+            idle = self.poll_interval
+            task = asyncio.create_task(self._run_job(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _heartbeat(self, job: Job):
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await self.queue.heartbeat(job.id, job.owner):
+                logging.warning(f"Lost the lease on job {job.id}")
+                return
+
+    async def _run_job(self, job: Job):
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            handler = self.handlers.get(job.kind)
+            if handler is None:
+                raise Exception(f"No handler for job kind {job.kind!r}")
+            await handler(job)
+        except asyncio.CancelledError:
+            await self.queue.release(job)
+            raise
+        except LeaseLost as e:
+            logging.warning(str(e))
+        except Exception as e:
+            logging.error(f"Job {job.id} ({job.kind}) failed on attempt {job.attempts}: {e}")
+            await self.queue.nack(job, str(e))
+        else:
+            await self.queue.ack(job.id, job.owner)
+        finally:
+            heartbeat.cancel()
+            self._slots.release()
+
+    async def stop(self, timeout: float | None = None):
+        self._stopping.set()
+        self.queue.new_jobs.set()
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        # Whatever is still running goes back to the queue for someone else
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
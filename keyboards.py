@@ -1,13 +1,23 @@
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-def get_main_keyboard(packs, current_pack_id):
+def get_main_keyboard(packs, current_pack_id, page: int = 0, total: int = 0, page_size: int = 8):
     buttons = []
     
     for pack in packs:
-        pack_id, _, _, title, pack_type = pack
+        pack_id, title, pack_type = pack
         type_icon = "📦" if pack_type == "regular" else "😀"
         text = f"✅ {type_icon} {title}" if pack_id == current_pack_id else f"{type_icon} {title}"
-        buttons.append([InlineKeyboardButton(text=text, callback_data=f"select_{pack_id}")])
+        buttons.append([InlineKeyboardButton(text=text, callback_data=f"select_{pack_id}_{page}")])
+
+    pages = (total + page_size - 1) // page_size
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton(text="◀️", callback_data=f"packs_page_{page - 1}"))
+        nav.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton(text="▶️", callback_data=f"packs_page_{page + 1}"))
+        buttons.append(nav)
     
     buttons.append([InlineKeyboardButton(text="➕ Создать новый пак", callback_data="create_pack")])
     
@@ -24,11 +34,9 @@ def get_pack_type_keyboard():
         [InlineKeyboardButton(text="😀 Эмодзи пак", callback_data="type_custom_emoji")]
     ])
 
-    ])
-
-def get_delete_sticker_keyboard(file_id: str):
+def get_delete_sticker_keyboard(sticker_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🗑 Да, удалить", callback_data=f"del_sticker_{file_id}")],
+        [InlineKeyboardButton(text="🗑 Да, удалить", callback_data=f"del_sticker_{sticker_id}")],
         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")]
     ])
 
@@ -1,9 +1,76 @@
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from config import BOT_TOKEN
-from middlewares import ThrottlingMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import (
+    BOT_TOKEN,
+    BOT_API_URL,
+    MEDIA_WORKERS,
+    MEDIA_QUEUE_LIMIT,
+    MEDIA_JOB_TIMEOUT,
+    CACHE_DIR,
+    CACHE_MEMORY_BYTES,
+    CACHE_DISK_BYTES,
+    FSM_STORAGE,
+    FSM_STATE_TTL,
+    FSM_SHARED,
+    THROTTLE_RATE,
+    THROTTLE_BURST,
+    THROTTLE_QUEUE_LIMIT,
+    THROTTLE_MAX_ACTIVE,
+    SUBSCRIPTION_POSITIVE_TTL,
+    SUBSCRIPTION_NEGATIVE_TTL,
+    API_GLOBAL_RATE,
+    API_CHAT_RATE,
+    API_CHAT_BURST,
+    API_MAX_ATTEMPTS,
+    API_STICKER_ADD_RATE,
+    API_STICKER_ADD_BURST,
+    API_SET_CREATE_RATE,
+    API_SET_CREATE_BURST,
+    API_STICKER_UPLOAD_RATE,
+    API_STICKER_UPLOAD_BURST,
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    MENU_CACHE_TTL,
+    STATS_FLUSH_INTERVAL,
+)
+from cache import MenuCache, StickerCache
+from database import db
+from jobqueue import JobQueue
+from media import MediaEngine
+from middlewares import ThrottlingMiddleware, SubscriptionCache
+from ratelimit import RateLimitMiddleware
+from stats import StatsRecorder
+from storage import create_storage
 
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+bot = Bot(
+    token=BOT_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None,
+)
+rate_limiter = RateLimitMiddleware(
+    global_rate=API_GLOBAL_RATE,
+    chat_rate=API_CHAT_RATE,
+    chat_burst=API_CHAT_BURST,
+    max_attempts=API_MAX_ATTEMPTS,
+    method_limits={
+        "addStickerToSet": (API_STICKER_ADD_RATE, API_STICKER_ADD_BURST),
+        "createNewStickerSet": (API_SET_CREATE_RATE, API_SET_CREATE_BURST),
+        "uploadStickerFile": (API_STICKER_UPLOAD_RATE, API_STICKER_UPLOAD_BURST),
+    },
+)
+bot.session.middleware(rate_limiter)
+storage = create_storage(FSM_STORAGE, state_ttl=FSM_STATE_TTL, shared=FSM_SHARED)
 dp = Dispatcher(storage=storage)
-dp.message.middleware(ThrottlingMiddleware())
+throttling = ThrottlingMiddleware(
+    rate=THROTTLE_RATE,
+    burst=THROTTLE_BURST,
+    queue_limit=THROTTLE_QUEUE_LIMIT,
+    max_active=THROTTLE_MAX_ACTIVE,
+)
+dp.message.middleware(throttling)
+media_engine = MediaEngine(MEDIA_WORKERS, MEDIA_QUEUE_LIMIT, MEDIA_JOB_TIMEOUT)
+sticker_cache = StickerCache(CACHE_DIR, CACHE_MEMORY_BYTES, CACHE_DISK_BYTES)
+pack_menus = MenuCache(MENU_CACHE_TTL)
+subscription_cache = SubscriptionCache(SUBSCRIPTION_POSITIVE_TTL, SUBSCRIPTION_NEGATIVE_TTL)
+job_queue = JobQueue(db, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS)
+stats = StatsRecorder(STATS_FLUSH_INTERVAL)
@@ -1,29 +1,96 @@
 import asyncio
 import logging
-from config import BOT_TOKEN
-from loader import bot, dp
-from database import init_db
-from handlers import router
+import time
+from config import (
+    BOT_TOKEN,
+    BOT_MODE,
+    MEDIA_JOB_TIMEOUT,
+    METRICS_HOST,
+    METRICS_PORT,
+    JOB_QUEUE,
+    JOB_WORKER_CONCURRENCY,
+)
+from loader import bot, dp, job_queue, media_engine, stats, subscription_cache
+from jobqueue import JobWorker
+from database import db, init_db
+from handlers import router, media_groups, run_sticker_job
+from metrics import register_runtime_metrics, start_metrics_server
 
 logging.basicConfig(level=logging.INFO)
 
-async def main():
-    if not BOT_TOKEN:
-        print("Error: BOT_TOKEN not found in .env file")
-        return
-    
+
+metrics_runner = None
+job_worker: JobWorker | None = None
+job_worker_task: asyncio.Task | None = None
+
+
+async def warm_up():
+    # Pays the first-request costs up front: bot identity, ffmpeg check and
+    # the media workers with Pillow already imported
+    started = time.perf_counter()
+    me, video, workers = await asyncio.gather(
+        bot.me(), media_engine.check_ffmpeg(), media_engine.warm_up(), return_exceptions=True
+    )
+    for name, result in (("getMe", me), ("ffmpeg check", video), ("media workers", workers)):
+        if isinstance(result, Exception):
+            logging.warning(f"Warm-up: {name} failed: {result}")
+    logging.info(f"Warm-up done in {time.perf_counter() - started:.2f}s")
+
+
+async def on_startup(worker_index: int = 0):
+    global metrics_runner, job_worker, job_worker_task
     await init_db()
-    
-    from middlewares import SubscriptionMiddleware
-    router.message.middleware(SubscriptionMiddleware())
+    media_engine.start()
+    await warm_up()
+    stats.start()
+    if JOB_QUEUE == "local":
+        job_worker = JobWorker(job_queue, {"stickers": run_sticker_job}, JOB_WORKER_CONCURRENCY)
+        job_worker_task = asyncio.create_task(job_worker.run())
+    if METRICS_PORT:
+        # Webhook workers are separate processes, each exposes its own port
+        port = METRICS_PORT + worker_index
+        metrics_runner = await start_metrics_server(METRICS_HOST, port)
+        logging.info(f"Metrics on http://{METRICS_HOST}:{port}/metrics")
+
+
+async def on_shutdown():
+    await media_groups.wait_closed()
+    if job_worker:
+        await job_worker.stop(timeout=MEDIA_JOB_TIMEOUT)
+        await job_worker_task
+    await media_engine.shutdown(drain_timeout=MEDIA_JOB_TIMEOUT)
+    await stats.stop()
+    await db.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+
+def setup_dispatcher():
+    from middlewares import SubscriptionMiddleware, UpdateTimingMiddleware
+    router.message.middleware(SubscriptionMiddleware(subscription_cache))
+    dp.update.outer_middleware(UpdateTimingMiddleware())
+    register_runtime_metrics()
     
     dp.include_router(router)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+
+async def main():
+    setup_dispatcher()
     
     print("Starting bot...")
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("Bot stopped")
+    if not BOT_TOKEN:
+        print("Error: BOT_TOKEN not found in .env file")
+    elif BOT_MODE == "webhook":
+        import webhook
+        setup_dispatcher()
+        webhook.run()
+    else:
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            print("Bot stopped")
@@ -0,0 +1,288 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from utils import needs_seekable_input, process_animation, process_image, video_sticker_steps
+
+PIPE_CHUNK_SIZE = 64 * 1024
+MAX_FFMPEG_OUTPUT = 8 * 1024 * 1024
+MAX_FFMPEG_STDERR = 64 * 1024
+
+
+class MediaQueueFull(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Media queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class MediaJobTimeout(Exception):
+    pass
+
+
+def _encode_image(source: bytes | bytearray | str, is_emoji: bool, output_format: str, png_compress_level: int) -> bytes:
+    # Runs inside a pool worker, so only plain bytes (or a path to a spooled
+    # download, which is cheaper still) cross the process boundary
+    return process_image(
+        source if isinstance(source, str) else BytesIO(source),
+        is_emoji=is_emoji,
+        output_format=output_format,
+        png_compress_level=png_compress_level,
+    ).getvalue()
+
+
+def _encode_animation(source: bytes | bytearray | str, is_emoji: bool, timeout: float) -> bytes:
+    # Decoding and the ffmpeg pipe both stay in the worker, only the WebM comes back
+    return process_animation(source if isinstance(source, str) else BytesIO(source), is_emoji=is_emoji, timeout=timeout)
+
+
+def _warm_up_worker() -> int:
+    # Imports Pillow and its codecs and runs a tiny encode, so the first real
+    # job in this worker does not pay for it
+    from PIL import Image
+
+    sample = BytesIO()
+    Image.new("RGBA", (64, 48), (255, 0, 0, 128)).save(sample, format="PNG")
+    for output_format in ("png", "webp"):
+        for is_emoji in (False, True):
+            _encode_image(sample.getvalue(), is_emoji, output_format, 6)
+    # Stay busy for a moment so the pool starts a new process for the next call
+    time.sleep(0.05)
+    return os.getpid()
+
+
+def _pool_context() -> multiprocessing.context.BaseContext:
+    context = multiprocessing.get_context("forkserver")
+    # Every worker re-runs the parent's __main__ before taking jobs (the forkserver's
+    # own "__main__" preload does nothing on 3.11). Importing the entry module once
+    # in the forkserver leaves each worker only the module body to run, all of its
+    # imports are already loaded.
+    modules = ["media"]
+    main = sys.modules["__main__"]
+    if getattr(main, "__spec__", None) is not None:
+        modules.append(main.__spec__.name)
+    elif getattr(main, "__file__", None):
+        modules.append(os.path.splitext(os.path.basename(main.__file__))[0])
+    context.set_forkserver_preload(modules)
+    return context
+
+
+class MediaEngine:
+    def __init__(self, workers: int, queue_limit: int, job_timeout: float):
+        self.workers = max(1, workers)
+        self.queue_limit = max(self.workers, queue_limit)
+        self.job_timeout = job_timeout
+        self._executor: ProcessPoolExecutor | None = None
+        self._ffmpeg_slots = asyncio.Semaphore(self.workers)
+        self._pending = 0
+        self._avg_job_time = 1.0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # None until check_ffmpeg() has run
+        self.video_available: bool | None = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def avg_job_time(self) -> float:
+        return self._avg_job_time
+
+    def start(self):
+        if self._executor is None:
+            # By now aiosqlite and aiohttp have threads running; forking next to
+            # them can leave a lock held forever in the child, so workers come
+            # from a clean forkserver process instead
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+
+    async def warm_up(self) -> int:
+        """Starts every pool worker and primes it; returns how many came up."""
+        self.start()
+        loop = asyncio.get_running_loop()
+        pids = await asyncio.gather(*(loop.run_in_executor(self._executor, _warm_up_worker) for _ in range(self.workers)))
+        return len(set(pids))
+
+    async def check_ffmpeg(self) -> bool:
+        # Every video job spawns its own ffmpeg, so there is no process to keep
+        # warm; one tiny VP9 encode pulls the binary and codec libraries into
+        # the page cache instead
+        try:
+            encoders = await self.run_ffmpeg(["ffmpeg", "-hide_banner", "-encoders"])
+            if b"libvpx-vp9" not in encoders:
+                raise Exception("ffmpeg is built without libvpx-vp9")
+            await self.run_ffmpeg(
+                [
+                    "ffmpeg", "-hide_banner", "-loglevel", "error",
+                    "-f", "lavfi", "-i", "color=c=black:s=64x64:d=0.1",
+                    "-c:v", "libvpx-vp9", "-deadline", "realtime", "-f", "webm", "pipe:1",
+                ]
+            )
+            await self.run_ffmpeg(["ffprobe", "-version"])
+        except Exception as e:
+            logging.warning(f"Video stickers are disabled: {e}")
+            self.video_available = False
+        else:
+            self.video_available = True
+        return self.video_available
+
+    async def shutdown(self, drain_timeout: float | None = None):
+        try:
+            await asyncio.wait_for(self._idle.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Media engine shut down with {self._pending} jobs in flight")
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_job_time * self._pending / self.workers))
+
+    def _acquire(self):
+        if self._pending >= self.queue_limit:
+            raise MediaQueueFull(self.retry_after())
+        self._pending += 1
+        self._idle.clear()
+        started = time.monotonic()
+
+        def release(*_):
+            elapsed = time.monotonic() - started
+            self._avg_job_time = 0.8 * self._avg_job_time + 0.2 * elapsed
+            self._pending -= 1
+            if not self._pending:
+                self._idle.set()
+
+        return release
+
+    async def process_image(
+        self,
+        data: bytes | bytearray | str,
+        is_emoji: bool = False,
+        output_format: str = "png",
+        png_compress_level: int = 6,
+    ) -> bytes:
+        return await self._run_in_pool("Image processing", _encode_image, data, is_emoji, output_format, png_compress_level)
+
+    async def process_animation(self, data: bytes | bytearray | str, is_emoji: bool = False) -> bytes:
+        return await self._run_in_pool("Animation processing", _encode_animation, data, is_emoji, self.job_timeout)
+
+    async def _run_in_pool(self, label: str, func, *args):
+        self.start()
+        release = self._acquire()
+        future = asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        # A worker cannot be interrupted mid-encode, so the slot is only freed
+        # once it really finishes and the queue limit stays honest
+        future.add_done_callback(release)
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.job_timeout)
+        except asyncio.TimeoutError:
+            raise MediaJobTimeout(f"{label} took longer than {self.job_timeout}s")
+
+    async def run_ffmpeg(
+        self, command: list[str], input_data: bytes | bytearray | None = None, timeout: float | None = None
+    ) -> bytearray:
+        timeout = self.job_timeout if timeout is None else timeout
+        async with self._ffmpeg_slots:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdin=asyncio.subprocess.PIPE if input_data is not None else asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                output, stderr = await asyncio.wait_for(_communicate(process, input_data), timeout)
+            except asyncio.TimeoutError:
+                raise MediaJobTimeout(f"FFmpeg took longer than {self.job_timeout}s")
+            finally:
+                # Also runs on cancellation and errors, so ffmpeg is never left behind
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        if process.returncode != 0:
+            tail = stderr.decode(errors="replace").strip().splitlines()[-1:] or [""]
+            raise Exception(f"FFmpeg conversion failed ({process.returncode}): {tail[0]}")
+        return output
+
+    async def process_video(self, data: bytes | bytearray | str, is_emoji: bool = False) -> bytearray:
+        # `data` may also be the path of a download spooled to disk; the caller owns that file
+        release = self._acquire()
+        input_path = data if isinstance(data, str) else None
+        temp_path = None
+        try:
+            if input_path is None and needs_seekable_input(data):
+                input_path = temp_path = await asyncio.to_thread(_write_temp, data, ".mp4")
+            steps = video_sticker_steps(input_path or "pipe:0", is_emoji=is_emoji)
+            # The probe and every encoding pass share one job_timeout
+            deadline = time.monotonic() + self.job_timeout
+            try:
+                command = next(steps)
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise MediaJobTimeout(f"Video processing took longer than {self.job_timeout}s")
+                    output = await self.run_ffmpeg(command, None if input_path else data, remaining)
+                    command = steps.send(output)
+            except StopIteration as done:
+                return done.value
+            finally:
+                steps.close()
+        finally:
+            if temp_path:
+                os.remove(temp_path)
+            release()
+
+
+async def _communicate(process: asyncio.subprocess.Process, input_data: bytes | bytearray | None):
+    output, stderr, _, _ = await asyncio.gather(
+        _read_limited(process.stdout, MAX_FFMPEG_OUTPUT),
+        _read_tail(process.stderr, MAX_FFMPEG_STDERR),
+        _feed(process.stdin, input_data),
+        process.wait(),
+    )
+    return output, stderr
+
+
+async def _feed(stream: asyncio.StreamWriter | None, data: bytes | bytearray | None):
+    if stream is None:
+        return
+    view = memoryview(data)
+    try:
+        for offset in range(0, len(view), PIPE_CHUNK_SIZE):
+            stream.write(view[offset:offset + PIPE_CHUNK_SIZE])
+            await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg stops reading once it has the first 3 seconds it needs
+        pass
+    finally:
+        stream.close()
+
+
+async def _read_limited(stream: asyncio.StreamReader, limit: int) -> bytearray:
+    # Returned as is: copying it into bytes would double the peak for big outputs
+    output = bytearray()
+    while chunk := await stream.read(PIPE_CHUNK_SIZE):
+        output += chunk
+        if len(output) > limit:
+            raise Exception(f"FFmpeg output exceeded {limit} bytes")
+    return output
+
+
+async def _read_tail(stream: asyncio.StreamReader, limit: int) -> bytes:
+    # Keep draining so a chatty ffmpeg never blocks on a full stderr pipe
+    tail = b""
+    while chunk := await stream.read(PIPE_CHUNK_SIZE):
+        tail = (tail + chunk)[-limit:]
+    return tail
+
+
+def _write_temp(data: bytes | bytearray, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+        f.write(data)
+        return f.name
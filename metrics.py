@@ -0,0 +1,275 @@
+import bisect
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+# (sample suffix, labels, value)
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abstractmethod
+    def samples(self) -> List[Sample]:
+        ...
+
+
+class _LabeledMetric(Metric):
+    # Keeps one child per label combination; the child holds the values
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._children: Dict[tuple, object] = {}
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        ...
+
+    def _default(self):
+        return self.labels()
+
+    def samples(self) -> List[Sample]:
+        result = []
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, key))
+            result.extend((suffix, {**labels, **extra}, value) for suffix, extra, value in child.samples())
+        return result
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def samples(self):
+        return [("_total", {}, self.value)]
+
+
+class Counter(_LabeledMetric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self):
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            result.append(("_bucket", {"le": _format_value(bound)}, cumulative))
+        result.append(("_bucket", {"le": "+Inf"}, self.count))
+        result.append(("_sum", {}, self.sum))
+        result.append(("_count", {}, self.count))
+        return result
+
+
+class Histogram(_LabeledMetric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        # Gauges here are always read on scrape from the object that owns the value
+        super().__init__(name, documentation)
+        self.function = function
+
+    def samples(self) -> List[Sample]:
+        return [("", {}, self.function())]
+
+
+class CounterFamily(Metric):
+    """Exposes an existing collections.Counter (e.g. a middleware's `metrics`) under one label."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, label: str, source: Callable[[], Dict[str, float]]):
+        super().__init__(name, documentation, (label,))
+        self.source = source
+
+    def samples(self) -> List[Sample]:
+        label = self.labelnames[0]
+        return [("_total", {label: key}, value) for key, value in sorted(self.source().items())]
+
+
+class Registry:
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        metric.name = self.prefix + metric.name
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+        return self.register(Gauge(name, documentation, function))
+
+    def counter_family(self, name: str, documentation: str, label: str, source: Callable[[], Dict[str, float]]):
+        return self.register(CounterFamily(name, documentation, label, source))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception:
+                # A broken callback must not take the whole scrape down
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry(prefix="stickerbot_")
+
+DOWNLOAD_SECONDS = registry.histogram("download_seconds", "Time spent downloading files from Telegram")
+ENCODE_SECONDS = registry.histogram("encode_seconds", "Time spent encoding stickers", ("kind",))
+UPLOAD_SECONDS = registry.histogram("upload_seconds", "Time spent in sticker set mutations", ("method",))
+DB_QUERY_SECONDS = registry.histogram("db_query_seconds", "SQLite query latency", ("op",), buckets=DB_BUCKETS)
+UPDATE_SECONDS = registry.histogram("update_seconds", "Time to handle one update", ("type",))
+ERRORS = registry.counter("errors", "Errors by stage", ("stage",))
+
+
+def register_runtime_metrics():
+    # Values that already live on the singletons are read at scrape time
+    from loader import media_engine, rate_limiter, subscription_cache, throttling
+
+    registry.gauge("media_queue_depth", "Media jobs queued or running", lambda: media_engine.pending)
+    registry.gauge("media_avg_job_seconds", "Moving average of media job time", lambda: media_engine.avg_job_time)
+    registry.counter_family("throttle_updates", "Updates seen by the throttling middleware", "result", lambda: throttling.metrics)
+    registry.counter_family(
+        "subscription_checks",
+        "Subscription lookups by outcome",
+        "result",
+        lambda: {
+            "hit": subscription_cache.hits,
+            "miss": subscription_cache.misses,
+            "coalesced": subscription_cache.coalesced,
+        },
+    )
+    registry.counter_family(
+        "api_requests",
+        "Outbound Bot API requests and retries",
+        "result",
+        lambda: {key: value for key, value in rate_limiter.metrics.items() if not key.startswith("wait_seconds")},
+    )
+    registry.counter_family(
+        "api_wait_seconds",
+        "Time spent waiting for rate limit tokens",
+        "lane",
+        lambda: {
+            key.removeprefix("wait_seconds_"): value
+            for key, value in rate_limiter.metrics.items()
+            if key.startswith("wait_seconds")
+        },
+    )
+
+
+async def metrics_view(_: web.Request) -> web.Response:
+    return web.Response(
+        text=registry.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+def setup_routes(app: web.Application):
+    from profiler import setup_profiler_routes
+
+    app.router.add_get("/metrics", metrics_view)
+    setup_profiler_routes(app)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    setup_routes(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,11 +1,43 @@
+import asyncio
+from collections import Counter, deque
 from typing import Any, Awaitable, Callable, Dict
-from aiogram import BaseMiddleware
-from aiogram.types import Message
+from aiogram import BaseMiddleware, Bot
+from aiogram.types import Message, Update
 from cachetools import TTLCache
 
+from metrics import UPDATE_SECONDS
+from ratelimit import TokenBucket
+
+UNSUBSCRIBED_STATUSES = ("left", "kicked", "banned")
+
 class ThrottlingMiddleware(BaseMiddleware):
-    def __init__(self, rate_limit: float = 0.5):
-        self.cache = TTLCache(maxsize=10_000, ttl=rate_limit)
+    def __init__(
+        self,
+        rate: float = 2.0,
+        burst: int = 5,
+        queue_limit: int = 10,
+        max_active: int = 64,
+    ):
+        # Each user gets a token bucket; messages over the rate wait in a short
+        # per-user queue instead of being dropped, and queued users are served
+        # round-robin so one busy user cannot hold every handler slot
+        self.rate = rate
+        self.burst = burst
+        self.queue_limit = queue_limit
+        self.max_active = max_active
+        self._buckets: TTLCache = TTLCache(maxsize=100_000, ttl=600)
+        self._queues: Dict[int, deque] = {}
+        self._ring: deque = deque()
+        self._active = 0
+        self._wakeup = asyncio.Event()
+        self._pump: asyncio.Task | None = None
+        self.metrics = Counter()
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
 
     async def __call__(
         self,
@@ -13,19 +45,168 @@ class ThrottlingMiddleware(BaseMiddleware):
         event: Message,
         data: Dict[str, Any],
     ) -> Any:
-        if not isinstance(event, Message):
+        if not isinstance(event, Message) or not event.from_user:
             return await handler(event, data)
-            
+
+        if event.media_group_id:
+            # Album items arrive in a burst by design and are grouped later by
+            # MediaGroupAggregator, so they skip the per-user limit
+            self.metrics["albums"] += 1
+            return await handler(event, data)
+
         user_id = event.from_user.id
-        
-        if user_id in self.cache:
-            return
-            
-        self.cache[user_id] = True
-        return await handler(event, data)
+        bucket = self._bucket(user_id)
+        if user_id not in self._queues and self._active < self.max_active and bucket.time_until_available() <= 0:
+            bucket.take()
+            self._active += 1
+            self.metrics["passed"] += 1
+        else:
+            queue = self._queues.get(user_id)
+            if queue is not None and len(queue) >= self.queue_limit:
+                self.metrics["dropped"] += 1
+                return
+            await self._wait_turn(user_id)
+            self.metrics["delayed"] += 1
+
+        try:
+            return await handler(event, data)
+        finally:
+            self._active -= 1
+            self._wakeup.set()
+
+    async def _wait_turn(self, user_id: int):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            self._ring.append(user_id)
+        future = asyncio.get_running_loop().create_future()
+        queue.append(future)
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        self._wakeup.set()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Granted but cancelled before the handler ran: give the slot back
+            if future.done() and not future.cancelled():
+                self._active -= 1
+                self._wakeup.set()
+            raise
+
+    def _next_ready(self) -> float:
+        # Grant one queued message, taking users in turn; returns how long to
+        # wait before some user gets a token again, or 0 if one was granted
+        wait = None
+        for _ in range(len(self._ring)):
+            user_id = self._ring[0]
+            self._ring.rotate(-1)
+            queue = self._queues[user_id]
+            while queue and queue[0].done():
+                queue.popleft()
+            if not queue:
+                self._drop_user(user_id)
+                continue
+            bucket = self._bucket(user_id)
+            delay = bucket.time_until_available()
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            bucket.take()
+            self._active += 1
+            queue.popleft().set_result(None)
+            if not queue:
+                self._drop_user(user_id)
+            return 0.0
+        return wait if wait is not None else 0.0
+
+    def _drop_user(self, user_id: int):
+        del self._queues[user_id]
+        self._ring.remove(user_id)
+
+    async def _run(self):
+        while self._ring:
+            self._wakeup.clear()
+            if self._active >= self.max_active:
+                await self._wakeup.wait()
+                continue
+            wait = self._next_ready()
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        with UPDATE_SECONDS.labels(event.event_type).time():
+            return await handler(event, data)
+
+
+class SubscriptionCache:
+    def __init__(self, positive_ttl: float, negative_ttl: float, maxsize: int = 100_000):
+        self._subscribed = TTLCache(maxsize=maxsize, ttl=positive_ttl)
+        self._unsubscribed = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def set(self, user_id: int, subscribed: bool):
+        self.invalidate(user_id)
+        if subscribed:
+            self._subscribed[user_id] = True
+        else:
+            self._unsubscribed[user_id] = True
+
+    def invalidate(self, user_id: int):
+        self._subscribed.pop(user_id, None)
+        self._unsubscribed.pop(user_id, None)
+
+    async def is_subscribed(self, bot: Bot, channel_id: str, user_id: int) -> bool:
+        if user_id in self._subscribed:
+            self.hits += 1
+            return True
+        if user_id in self._unsubscribed:
+            self.hits += 1
+            return False
+
+        # Album items arrive together; let them share a single getChatMember call
+        future = self._inflight.get(user_id)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
+            subscribed = member.status not in UNSUBSCRIBED_STATUSES
+            self.set(user_id, subscribed)
+            future.set_result(subscribed)
+            return subscribed
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody may be waiting on the shared future; mark it retrieved
+            future.exception()
+            raise
+        finally:
+            del self._inflight[user_id]
 
 
 class SubscriptionMiddleware(BaseMiddleware):
+    def __init__(self, cache: SubscriptionCache):
+        self.cache = cache
+
     async def __call__(
         self,
         handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
@@ -46,8 +227,7 @@ class SubscriptionMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         try:
-            member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            if member.status in ["left", "kicked", "banned"]:
+            if not await self.cache.is_subscribed(bot, CHANNEL_ID, user_id):
                 await event.delete()
                 await event.answer(
                     "Йоу, чтобы юзать бота надо подписаться на канал создателя.\n"
@@ -0,0 +1,91 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+
+from aiohttp import web
+
+# Shorter intervals turn the sampler into a busy loop holding the GIL
+MIN_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads from a background thread.
+
+    Output is in the collapsed format ("frame;frame;frame count") that
+    flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self):
+        self.stacks: collections.Counter = collections.Counter()
+        self.samples = 0
+        self.started_at: float | None = None
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.005) -> bool:
+        if self.running:
+            return False
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> str:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self.collapsed()
+
+    def _run(self, interval: float):
+        own = threading.get_ident()
+        while not self._stop.wait(interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+profiler = SamplingProfiler()
+
+
+async def profile_status(_: web.Request) -> web.Response:
+    elapsed = time.monotonic() - profiler.started_at if profiler.started_at else 0
+    return web.json_response({"running": profiler.running, "samples": profiler.samples, "seconds": round(elapsed, 1)})
+
+
+async def profile_start(request: web.Request) -> web.Response:
+    interval = max(MIN_INTERVAL, float(request.query.get("interval", 0.005)))
+    if not profiler.start(interval):
+        return web.Response(status=409, text="already running\n")
+    return web.Response(text="started\n")
+
+
+async def profile_stop(_: web.Request) -> web.Response:
+    # stop() joins the sampler thread, which can take a whole interval
+    return web.Response(text=await asyncio.to_thread(profiler.stop))
+
+
+def setup_profiler_routes(app: web.Application):
+    app.router.add_get("/debug/profile", profile_status)
+    app.router.add_post("/debug/profile/start", profile_start)
+    app.router.add_post("/debug/profile/stop", profile_stop)
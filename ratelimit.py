@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import random
+import time
+from collections import Counter, deque
+from typing import Dict, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import GetUpdates, Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+from cachetools import TTLCache
+
+INTERACTIVE = 0
+BULK = 1
+
+BULK_METHODS = {
+    "addStickerToSet",
+    "createNewStickerSet",
+    "uploadStickerFile",
+    "deleteStickerFromSet",
+    "getStickerSet",
+    "answerCallbackQuery",
+}
+
+# Methods that post to a chat and so count against its ~1 message/s limit.
+# Sticker-set calls carry the owner's user_id but have their own limits below,
+# and getChatMember's chat_id is the channel shared by every user
+CHAT_METHODS = {
+    "sendMessage",
+    "sendPhoto",
+    "sendDocument",
+    "sendVideo",
+    "sendAnimation",
+    "sendSticker",
+    "sendMediaGroup",
+    "copyMessage",
+    "forwardMessage",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageMedia",
+    "editMessageReplyMarkup",
+    "deleteMessage",
+}
+
+# Safe to repeat after a network or 5xx error, when the first request may
+# already have gone through; repeating addStickerToSet could add the sticker twice
+IDEMPOTENT_METHODS = {
+    "getMe",
+    "getFile",
+    "getChatMember",
+    "getStickerSet",
+    "answerCallbackQuery",
+    "uploadStickerFile",
+    "setWebhook",
+    "deleteWebhook",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+}
+
+# Telegram does not publish limits for sticker-set methods; these keep one
+# user's bursts well below the point where flood waits start. Each set owner
+# gets their own buckets, only the global rate is shared
+METHOD_LIMITS: Dict[str, Tuple[float, int]] = {
+    "addStickerToSet": (5.0, 5),
+    "createNewStickerSet": (1.0, 2),
+    "uploadStickerFile": (5.0, 5),
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        # Take a token now, possibly going into debt, and return how long the
+        # caller has to wait for it; callers are served in arrival order
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def time_until_available(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class PriorityLimiter:
+    def __init__(self, rate: float, capacity: int):
+        self.bucket = TokenBucket(rate, capacity)
+        self._queues = (deque(), deque())
+        self._pump: asyncio.Task | None = None
+
+    def depth(self, priority: int) -> int:
+        return len(self._queues[priority])
+
+    async def acquire(self, priority: int):
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(future)
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await future
+
+    async def _run(self):
+        # Hands out global tokens, always draining the interactive lane first
+        while True:
+            queue = next((q for q in self._queues if q), None)
+            if queue is None:
+                return
+            delay = self.bucket.time_until_available()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            future = queue.popleft()
+            if not future.done():
+                self.bucket.take()
+                future.set_result(None)
+
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    def __init__(
+        self,
+        global_rate: float = 30.0,
+        chat_rate: float = 1.0,
+        chat_burst: int = 3,
+        max_attempts: int = 5,
+        base_backoff: float = 0.5,
+        method_limits: Dict[str, Tuple[float, int]] | None = None,
+    ):
+        self.limiter = PriorityLimiter(global_rate, int(global_rate))
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self._chats: TTLCache = TTLCache(maxsize=100_000, ttl=600)
+        self.method_limits = METHOD_LIMITS if method_limits is None else method_limits
+        self._owners: TTLCache = TTLCache(maxsize=100_000, ttl=600)
+        self.metrics = Counter()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _method_bucket(self, method_name: str, owner) -> TokenBucket | None:
+        limit = self.method_limits.get(method_name)
+        if limit is None:
+            return None
+        bucket = self._owners.get((method_name, owner))
+        if bucket is None:
+            bucket = self._owners[(method_name, owner)] = TokenBucket(*limit)
+        return bucket
+
+    async def _wait_turn(
+        self, method_bucket: TokenBucket | None, chat_bucket: TokenBucket | None, priority: int
+    ):
+        started = time.monotonic()
+        delays = [bucket.reserve() for bucket in (method_bucket, chat_bucket) if bucket]
+        if delays and max(delays) > 0:
+            await asyncio.sleep(max(delays))
+        await self.limiter.acquire(priority)
+        self.metrics[f"wait_seconds_{'bulk' if priority else 'interactive'}"] += time.monotonic() - started
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+
+        method_name = method.__api_method__
+        priority = BULK if method_name in BULK_METHODS else INTERACTIVE
+        chat_id = getattr(method, "chat_id", None) if method_name in CHAT_METHODS else None
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+        method_bucket = self._method_bucket(method_name, getattr(method, "user_id", None))
+
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._wait_turn(method_bucket, chat_bucket, priority)
+            self.metrics["requests"] += 1
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                self.metrics["flood_waits"] += 1
+                if attempt >= self.max_attempts:
+                    self.metrics["failures"] += 1
+                    raise
+                delay = e.retry_after + random.uniform(0, 1)
+                # Everyone else making the same call would hit the same wall
+                (chat_bucket or method_bucket or self.limiter.bucket).pause(delay)
+                logging.warning(f"Flood wait on {method_name}: retrying in {delay:.1f}s")
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= self.max_attempts or method_name not in IDEMPOTENT_METHODS:
+                    self.metrics["failures"] += 1
+                    raise
+                # Full jitter exponential backoff
+                delay = random.uniform(0, self.base_backoff * 2 ** (attempt - 1))
+                logging.warning(f"{method_name} failed ({e}), retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            self.metrics["retries"] += 1
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+from database import STATS_METRICS, flush_stats, get_daily_stats, get_global_stats, get_user_stats
+
+
+def _today() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+class StatsRecorder:
+    """Usage counters buffered in memory and written in batches.
+
+    Reads add whatever is still buffered, so answers are current even between
+    flushes (daily active users lag by one flush). A crash loses at most one
+    flush interval of counts.
+    """
+
+    def __init__(self, flush_interval: float = 5.0, max_pending: int = 1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._users: Dict[int, Counter] = defaultdict(Counter)
+        self._totals: Counter = Counter()
+        self._daily: Counter = Counter()
+        self._active: set = set()
+        self._flusher: asyncio.Task | None = None
+        self._flushing = asyncio.Lock()
+
+    def record(self, user_id: int, **deltas: int):
+        day = _today()
+        deltas = {metric: value for metric, value in deltas.items() if value}
+        self._users[user_id].update(deltas)
+        self._totals.update(deltas)
+        self._daily.update({(day, metric): value for metric, value in deltas.items()})
+        self._active.add((day, user_id))
+        if len(self._users) >= self.max_pending and not self._flushing.locked():
+            asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        async with self._flushing:
+            if not self._users and not self._active:
+                return
+            users, totals, daily, active = self._users, self._totals, self._daily, self._active
+            self._users, self._totals, self._daily, self._active = defaultdict(Counter), Counter(), Counter(), set()
+            try:
+                await flush_stats(users, totals, daily, active)
+            except Exception as e:
+                logging.error(f"Stats flush failed, keeping {len(users)} users for the next one: {e}")
+                for user_id, deltas in users.items():
+                    self._users[user_id].update(deltas)
+                self._totals.update(totals)
+                self._daily.update(daily)
+                self._active |= active
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self.flush()
+
+    async def user(self, user_id: int) -> Dict[str, int]:
+        stats = await get_user_stats(user_id)
+        for metric, value in self._users.get(user_id, {}).items():
+            stats[metric] += value
+        return stats
+
+    async def totals(self) -> Dict[str, int]:
+        stats = dict.fromkeys(STATS_METRICS, 0)
+        stats.update(await get_global_stats())
+        for metric, value in self._totals.items():
+            stats[metric] += value
+        return stats
+
+    async def daily(self, days: int = 7) -> List[Tuple[str, Dict[str, int]]]:
+        since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 86400))
+        report: Dict[str, Counter] = defaultdict(Counter)
+        for day, metric, value in await get_daily_stats(since):
+            report[day][metric] += value
+        for (day, metric), value in self._daily.items():
+            report[day][metric] += value
+        return sorted(report.items())
@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+from aiogram.types import BufferedInputFile, File, InputSticker, Sticker
+
+from config import MEDIA_MAX_INPUT_BYTES, MEDIA_SPOOL_BYTES, STICKER_IMAGE_FORMAT, PNG_COMPRESS_LEVEL
+from database import (
+    add_pack_stickers,
+    get_sticker_by_unique_id,
+    replace_pack_stickers,
+    set_sticker_file_id,
+)
+from loader import bot, media_engine, stats
+from metrics import DOWNLOAD_SECONDS, ENCODE_SECONDS, ERRORS, UPLOAD_SECONDS
+from utils import IMAGE_FILENAMES, is_animated_image, is_webm
+
+# Telegram caps sticker sets by type
+SET_CAPACITY = {
+    "regular": 120,
+    "custom_emoji": 200,
+}
+# createNewStickerSet accepts at most this many initial stickers
+CREATE_BATCH_SIZE = 50
+
+_reconciling: Dict[int, asyncio.Task] = {}
+
+
+async def add_sticker(user_id: int, pack, input_sticker: InputSticker):
+    pack_id, pack_name = pack[:2]
+    # Flood waits and transient errors are retried by the session's RateLimitMiddleware
+    try:
+        with UPLOAD_SECONDS.labels("addStickerToSet").time():
+            await bot.add_sticker_to_set(
+                user_id=user_id,
+                name=pack_name,
+                sticker=input_sticker
+            )
+    except Exception as e:
+        ERRORS.labels("upload").inc()
+        if is_full_set_error(e):
+            # The mirror undercounted, e.g. stickers were added through @Stickers
+            await reconcile_pack(pack_id, pack_name)
+        raise
+    await add_pack_stickers(pack_id, input_sticker.emoji_list[:1])
+    stats.record(user_id, stickers_added=1)
+
+
+def is_missing_set_error(e: Exception) -> bool:
+    return "STICKERSET_INVALID" in str(e) or "set not found" in str(e).lower()
+
+
+def is_full_set_error(e: Exception) -> bool:
+    return "STICKERS_TOO_MUCH" in str(e)
+
+
+async def create_sticker_set(user_id: int, pack, stickers: List[InputSticker]):
+    pack_id, pack_name, pack_title, pack_type = pack[:4]
+    try:
+        with UPLOAD_SECONDS.labels("createNewStickerSet").time():
+            await bot.create_new_sticker_set(
+                user_id=user_id,
+                name=pack_name,
+                title=pack_title,
+                stickers=stickers,
+                sticker_format=stickers[0].format,
+                sticker_type=pack_type,
+            )
+    except Exception:
+        ERRORS.labels("upload").inc()
+        raise
+    # A fresh set holds exactly these; file ids are filled in on the next reconcile
+    await replace_pack_stickers(pack_id, [(None, None, sticker.emoji_list[0]) for sticker in stickers])
+    stats.record(user_id, stickers_added=len(stickers))
+
+
+async def upload_sticker(user_id: int, data: bytes | bytearray, is_video: bool) -> InputSticker:
+    # The bytes go up once; every later set call (and any retry) only sends the file_id
+    sticker = make_input_sticker(data, is_video)
+    try:
+        with UPLOAD_SECONDS.labels("uploadStickerFile").time():
+            file = await bot.upload_sticker_file(
+                user_id=user_id,
+                sticker=sticker.sticker,
+                sticker_format=sticker.format,
+            )
+    except Exception:
+        ERRORS.labels("upload").inc()
+        raise
+    return make_input_sticker(file.file_id, sticker.format == "video")
+
+
+def is_name_occupied_error(e: Exception) -> bool:
+    return "NAME_OCCUPIED" in str(e) or "already occupied" in str(e).lower()
+
+
+class SetFiller:
+    """Adds stickers to a set in the order they are pushed.
+
+    If the set does not exist yet, stickers are collected and the set is
+    created with up to CREATE_BATCH_SIZE of them in one call. Adds run in the
+    background, at most `concurrency` at a time, so callers can prepare the
+    next sticker meanwhile; with concurrency 1 the set keeps the push order.
+    """
+
+    def __init__(self, user_id: int, pack, exists: bool = True, concurrency: int = 1):
+        self.user_id = user_id
+        self.pack = pack
+        self.exists = exists
+        self.created = False
+        self.added = 0
+        self.errors: List[str] = []
+        self._batch: List[Tuple[InputSticker, Callable | None, Callable | None]] = []
+        self._slots = asyncio.Semaphore(max(1, concurrency))
+        self._tasks: set[asyncio.Task] = set()
+
+    async def push(
+        self,
+        sticker: InputSticker,
+        label: str | None = None,
+        on_done: Callable[[], Awaitable[None]] | None = None,
+        reupload: Callable[[], Awaitable[InputSticker]] | None = None,
+    ):
+        # on_done runs once the sticker is settled: added, created with the set, or failed.
+        # reupload gives a freshly uploaded copy when the set call refuses this one
+        if not self.exists:
+            self._batch.append((sticker, on_done, reupload))
+            if len(self._batch) == CREATE_BATCH_SIZE:
+                await self._create()
+            return
+        await self._slots.acquire()
+        task = asyncio.create_task(self._add(sticker, label, on_done, reupload))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _add(self, sticker: InputSticker, label: str | None, on_done, reupload):
+        try:
+            try:
+                try:
+                    await add_sticker(self.user_id, self.pack, sticker)
+                except Exception as e:
+                    if reupload is None or is_missing_set_error(e):
+                        raise
+                    logging.warning(f"Sticker file was refused ({e}), uploading it again")
+                    sticker, reupload = await reupload(), None
+                    await add_sticker(self.user_id, self.pack, sticker)
+                self.added += 1
+            except Exception as e:
+                if is_missing_set_error(e) and not self.created:
+                    # The set is gone (or never was); the rest goes into a new one
+                    self.exists = False
+                    self._batch.append((sticker, on_done, reupload))
+                    return
+                logging.error(f"Error adding sticker: {e}")
+                stats.record(self.user_id, failures=1)
+                self.errors.append(f"{label}: {e}" if label else f"Не удалось добавить стикер: {e}")
+            if on_done:
+                await on_done()
+        finally:
+            self._slots.release()
+
+    async def _create(self):
+        batch, self._batch = self._batch, []
+        try:
+            try:
+                await create_sticker_set(self.user_id, self.pack, [sticker for sticker, _, _ in batch])
+            except Exception as e:
+                if is_name_occupied_error(e) or not any(reupload for _, _, reupload in batch):
+                    raise
+                logging.warning(f"Sticker set creation refused ({e}), uploading cached files again")
+                batch = [((await reupload()) if reupload else sticker, on_done, None) for sticker, on_done, reupload in batch]
+                await create_sticker_set(self.user_id, self.pack, [sticker for sticker, _, _ in batch])
+        except Exception as e:
+            if not is_name_occupied_error(e):
+                raise
+            # The set exists but the local mirror did not know about it
+            self.exists = True
+            for sticker, on_done, reupload in batch:
+                await self.push(sticker, on_done=on_done, reupload=reupload)
+            return
+        self.created = self.exists = True
+        self.added += len(batch)
+        for _, on_done, _ in batch:
+            if on_done:
+                await on_done()
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks)
+        if self._batch:
+            await self._create()
+            if self._tasks:
+                await asyncio.gather(*self._tasks)
+
+
+async def reconcile_pack(pack_id: int, pack_name: str) -> int | None:
+    """Refresh the local mirror from getStickerSet; returns the sticker count, None if the set does not exist."""
+    task = _reconciling.get(pack_id)
+    if task is None:
+        task = _reconciling[pack_id] = asyncio.create_task(_reconcile(pack_id, pack_name))
+        task.add_done_callback(lambda _: _reconciling.pop(pack_id, None))
+    return await asyncio.shield(task)
+
+
+async def _reconcile(pack_id: int, pack_name: str) -> int | None:
+    try:
+        sticker_set = await bot.get_sticker_set(name=pack_name)
+    except Exception as e:
+        if not is_missing_set_error(e):
+            raise
+        await replace_pack_stickers(pack_id, [])
+        return None
+    await replace_pack_stickers(
+        pack_id,
+        [(sticker.file_id, sticker.file_unique_id, sticker.emoji) for sticker in sticker_set.stickers],
+    )
+    return len(sticker_set.stickers)
+
+
+async def room_left(pack) -> int:
+    pack_id, pack_name, _, pack_type, sticker_count = pack
+    capacity = SET_CAPACITY.get(pack_type, SET_CAPACITY["regular"])
+    if sticker_count >= capacity:
+        # Only ask Telegram when the mirror says the set is full
+        sticker_count = await reconcile_pack(pack_id, pack_name) or 0
+    return capacity - sticker_count
+
+
+async def remember_sticker(pack_id: int, pack_name: str, sticker: Sticker) -> int | None:
+    # Local id of a sticker the user sent us, reconciling once if the mirror lacks it
+    row = await get_sticker_by_unique_id(pack_id, sticker.file_unique_id)
+    if row is None:
+        await reconcile_pack(pack_id, pack_name)
+        row = await get_sticker_by_unique_id(pack_id, sticker.file_unique_id)
+        if row is None:
+            return None
+    sticker_id, file_id = row
+    if file_id != sticker.file_id:
+        await set_sticker_file_id(sticker_id, sticker.file_id)
+    return sticker_id
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class DownloadBuffer:
+    """Write target for bot.download_file that fills one bytearray sized from file_size."""
+
+    def __init__(self, size_hint: int | None, limit: int):
+        self.data = bytearray(size_hint or 0)
+        self.size = 0
+        self.limit = limit
+
+    def write(self, chunk: bytes):
+        end = self.size + len(chunk)
+        if end > self.limit:
+            raise MediaTooLarge(f"Download exceeded {self.limit} bytes")
+        if end <= len(self.data):
+            self.data[self.size:end] = chunk
+        else:
+            # file_size was missing or wrong; fall back to growing in place
+            del self.data[self.size:]
+            self.data += chunk
+        self.size = end
+
+    def flush(self):
+        pass
+
+    def getbuffer(self) -> bytearray:
+        del self.data[self.size:]
+        return self.data
+
+
+@asynccontextmanager
+async def download_media(file: File) -> AsyncIterator[bytearray | str]:
+    """Yield the file as a bytearray, or as a temp file path when it is big."""
+    if file.file_size and file.file_size > MEDIA_MAX_INPUT_BYTES:
+        raise MediaTooLarge(f"File is {file.file_size} bytes, limit is {MEDIA_MAX_INPUT_BYTES}")
+
+    if file.file_size and file.file_size > MEDIA_SPOOL_BYTES:
+        # Big inputs go straight to disk: ffmpeg and Pillow read the path
+        # themselves, and nothing large crosses the process pool
+        fd, path = tempfile.mkstemp(prefix="sticker-")
+        os.close(fd)
+        try:
+            with DOWNLOAD_SECONDS.time():
+                await bot.download_file(file.file_path, path)
+            yield path
+        finally:
+            os.remove(path)
+        return
+
+    buffer = DownloadBuffer(file.file_size, MEDIA_MAX_INPUT_BYTES)
+    with DOWNLOAD_SECONDS.time():
+        await bot.download_file(file.file_path, buffer, seek=False)
+    yield buffer.getbuffer()
+
+
+def sticker_variant(is_video: bool, is_emoji: bool) -> str:
+    if is_video:
+        return "video_emoji" if is_emoji else "video"
+    return f"{'emoji' if is_emoji else 'regular'}.{STICKER_IMAGE_FORMAT}"
+
+
+async def encode_media(data: bytes | bytearray | str, is_video: bool, is_emoji: bool) -> bytes:
+    # Animated GIF/APNG/WebP come back as WebM; make_input_sticker tells them apart by the bytes
+    kind = "video" if is_video else "image"
+    # Without a working ffmpeg an animation still becomes a sticker from its first frame
+    if not is_video and media_engine.video_available and await asyncio.to_thread(is_animated_image, data):
+        kind = "animation"
+    try:
+        with ENCODE_SECONDS.labels(kind).time():
+            if is_video:
+                return await media_engine.process_video(data, is_emoji=is_emoji)
+            if kind == "animation":
+                return await media_engine.process_animation(data, is_emoji=is_emoji)
+            return await media_engine.process_image(
+                data,
+                is_emoji=is_emoji,
+                output_format=STICKER_IMAGE_FORMAT,
+                png_compress_level=PNG_COMPRESS_LEVEL,
+            )
+    except Exception:
+        ERRORS.labels(f"encode_{kind}").inc()
+        raise
+
+
+def make_input_sticker(data: bytes | bytearray | str, is_video: bool) -> InputSticker:
+    # `data` is either the encoded file or the file_id of an uploaded one
+    if is_video or not isinstance(data, str) and is_webm(data):
+        filename, fmt = "sticker.webm", "video"
+    else:
+        filename, fmt = IMAGE_FILENAMES[STICKER_IMAGE_FORMAT], "static"
+    return InputSticker(
+        sticker=data if isinstance(data, str) else BufferedInputFile(data, filename=filename),
+        format=fmt,
+        emoji_list=["😀"]
+    )
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from database import Database, db
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        database: Database,
+        state_ttl: float = 24 * 60 * 60,
+        flush_interval: float = 0.5,
+        cache_ttl: float = 5.0,
+        shared: bool = False,
+        key_builder: KeyBuilder | None = None,
+    ):
+        self.database = database
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        # When other processes use the same table, a cached entry may already be
+        # stale, so every read goes to the database and every write is
+        # committed before the handler moves on
+        self.shared = shared
+        self.cache_ttl = 0.0 if shared else cache_ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+        self._cache: Dict[str, list] = {}
+        self._dirty: set[str] = set()
+        self._flusher: asyncio.Task | None = None
+        self._last_purge = 0.0
+
+    async def _load(self, key: StorageKey) -> list:
+        storage_key = self.key_builder.build(key)
+        now = time.time()
+        entry = self._cache.get(storage_key)
+        if entry and (storage_key in self._dirty or entry[3] > now):
+            if entry[2] and entry[2] < now:
+                entry[0], entry[1] = None, {}
+            return entry
+
+        row = await self.database.fetchone(
+            "SELECT state, data, expires_at FROM fsm_states WHERE key = ?", (storage_key,)
+        )
+        if row and (not row[2] or row[2] >= now):
+            entry = [row[0], json.loads(row[1] or "{}"), row[2], now + self.cache_ttl]
+        else:
+            entry = [None, {}, None, now + self.cache_ttl]
+        self._cache[storage_key] = entry
+        return entry
+
+    async def _touch(self, key: StorageKey, entry: list):
+        storage_key = self.key_builder.build(key)
+        now = time.time()
+        entry[2] = now + self.state_ttl if self.state_ttl else None
+        entry[3] = now + self.cache_ttl
+        self._cache[storage_key] = entry
+        self._dirty.add(storage_key)
+        if self.shared:
+            await self.flush()
+        elif self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._load(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        await self._touch(key, entry)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._load(key)
+        entry[1] = dict(data)
+        await self._touch(key, entry)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(key))[1])
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"FSM storage flush failed: {e}")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        upserts = []
+        deletes = []
+        for storage_key in dirty:
+            state, data, expires_at, _ = self._cache[storage_key]
+            if state is None and not data:
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, state, json.dumps(data, ensure_ascii=False), expires_at))
+
+        try:
+            async with self.database.transaction() as conn:
+                if upserts:
+                    await conn.executemany(
+                        "INSERT OR REPLACE INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?)",
+                        upserts,
+                    )
+                if deletes:
+                    await conn.executemany("DELETE FROM fsm_states WHERE key = ?", deletes)
+                if time.time() - self._last_purge > 60:
+                    await conn.execute("DELETE FROM fsm_states WHERE expires_at < ?", (time.time(),))
+                    self._last_purge = time.time()
+        except BaseException:
+            self._dirty |= dirty
+            raise
+
+        now = time.time()
+        for storage_key in [k for k, entry in self._cache.items() if entry[3] < now and k not in self._dirty]:
+            del self._cache[storage_key]
+
+    async def close(self) -> None:
+        if self._flusher and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+
+
+def create_storage(kind: str, **options) -> BaseStorage:
+    if kind == "sqlite":
+        return SQLiteStorage(db, **options)
+    if kind == "redis":
+        # Works with anything that speaks the Redis protocol (Redis, Valkey,
+        # KeyDB, or a local redis-server as a stand-in)
+        from aiogram.fsm.storage.redis import RedisStorage
+        from config import REDIS_URL
+
+        ttl = int(options.get("state_ttl") or 0) or None
+        return RedisStorage.from_url(
+            REDIS_URL,
+            key_builder=DefaultKeyBuilder(with_destiny=True),
+            state_ttl=ttl,
+            data_ttl=ttl,
+        )
+    return MemoryStorage()
@@ -1,74 +1,423 @@
+import json
+import math
 import os
+import shutil
 import subprocess
 import tempfile
+import threading
+from bisect import bisect_right
 from io import BytesIO
-from PIL import Image
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+IMAGE_FILENAMES = {
+    "png": "sticker.png",
+    "webp": "sticker.webp",
+}
+
+def _has_alpha(img: "Image.Image") -> bool:
+    return img.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in img.info
+
+def _fit_size(width: int, height: int, box: int) -> tuple[int, int]:
+    if width >= height:
+        return box, max(1, int(height * (box / width)))
+    return max(1, int(width * (box / height))), box
+
+def process_image(
+    image_data: BytesIO,
+    is_emoji: bool = False,
+    output_format: str = "png",
+    png_compress_level: int = 6,
+) -> BytesIO:
+    # Pillow is only needed in the media workers, so the bot process never imports it
+    from PIL import Image
 
-def process_image(image_data: BytesIO, is_emoji: bool = False) -> BytesIO:
     with Image.open(image_data) as img:
-        if img.mode != "RGBA":
-            img = img.convert("RGBA")
+        box = 100 if is_emoji else 512
+        size = _fit_size(img.width, img.height, box)
+
+        # JPEG can decode straight at 1/2, 1/4 or 1/8 scale, as long as the
+        # result stays at least as large as the final size
+        if img.format == "JPEG":
+            img.draft("RGB", size)
+
+        if _has_alpha(img):
+            if img.mode != "RGBA":
+                img = img.convert("RGBA")
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
 
-        if is_emoji:
-            img.thumbnail((100, 100), Image.Resampling.LANCZOS)
-            
+        # reducing_gap shrinks with a cheap box reduce() first and keeps only
+        # the last ~3x for the LANCZOS pass
+        img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        if is_emoji and img.size != (100, 100):
             canvas = Image.new("RGBA", (100, 100), (0, 0, 0, 0))
-            
             x = (100 - img.width) // 2
             y = (100 - img.height) // 2
             canvas.paste(img, (x, y))
             img = canvas
-        else:
-            width, height = img.size
-            if width >= height:
-                new_width = 512
-                new_height = int(height * (512 / width))
-            else:
-                new_height = 512
-                new_width = int(width * (512 / height))
-            
-            new_width = max(1, new_width)
-            new_height = max(1, new_height)
-            
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
 
         output = BytesIO()
-        img.save(output, format="PNG")
+        if output_format == "webp":
+            img.save(output, format="WEBP", quality=90, method=4)
+        else:
+            img.save(output, format="PNG", compress_level=png_compress_level)
         output.seek(0)
         return output
 
-def process_video(video_data: BytesIO) -> BytesIO:
-    with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_input:
-        temp_input.write(video_data.read())
-        input_path = temp_input.name
+VIDEO_STICKER_MAX_BYTES = 256 * 1024
+VIDEO_STICKER_MAX_DURATION = 3.0
+VIDEO_STICKER_MAX_FPS = 30
+
+class VideoInfo(NamedTuple):
+    width: int
+    height: int
+    fps: float
+    duration: float
+
+def build_probe_command(input_path: str = "pipe:0") -> list[str]:
+    return [
+        "ffprobe",
+        "-v", "error",
+        "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,avg_frame_rate,r_frame_rate,duration:format=duration",
+        "-of", "json",
+        input_path
+    ]
+
+def _parse_rate(rate: str | None) -> float:
+    if not rate or rate == "0/0":
+        return 0.0
+    num, _, den = rate.partition("/")
+    return float(num) / float(den or 1)
+
+def parse_probe(output: bytes) -> VideoInfo:
+    probe = json.loads(output or b"{}")
+    streams = probe.get("streams") or [{}]
+    stream = streams[0]
+    duration = stream.get("duration") or probe.get("format", {}).get("duration")
+    return VideoInfo(
+        width=int(stream.get("width") or 0),
+        height=int(stream.get("height") or 0),
+        fps=_parse_rate(stream.get("avg_frame_rate")) or _parse_rate(stream.get("r_frame_rate")),
+        duration=float(duration or 0),
+    )
+
+def build_video_filter(info: VideoInfo, is_emoji: bool) -> str:
+    fps = min(VIDEO_STICKER_MAX_FPS, round(info.fps) or VIDEO_STICKER_MAX_FPS)
+    if is_emoji:
+        scale = (
+            "scale=100:100:force_original_aspect_ratio=decrease,"
+            "pad=100:100:(ow-iw)/2:(oh-ih)/2:color=black@0"
+        )
+    else:
+        # One side must be exactly 512, the other at most 512
+        scale = "scale=512:512:force_original_aspect_ratio=decrease"
+    return f"fps={fps},{scale},format=yuva420p"
+
+def build_video_command(
+    input_path: str = "pipe:0",
+    output_path: str = "pipe:1",
+    video_filter: str = "scale=512:512:force_original_aspect_ratio=decrease",
+    duration: float = VIDEO_STICKER_MAX_DURATION,
+    rate_args: tuple[str, ...] = ("-b:v", "256k"),
+) -> list[str]:
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-i", input_path,
+        "-t", f"{duration:.3f}",
+        "-vf", video_filter,
+        "-c:v", "libvpx-vp9",
+        *rate_args,
+        "-an",
+        "-f", "webm",
+        "-y",
+        output_path
+    ]
+
+def video_sticker_steps(input_path: str = "pipe:0", is_emoji: bool = False):
+    # Yields ffmpeg/ffprobe commands and receives their stdout, so the same
+    # plan drives both the blocking and the asyncio subprocess runners
+    info = parse_probe((yield build_probe_command(input_path)))
+    duration = min(VIDEO_STICKER_MAX_DURATION, info.duration or VIDEO_STICKER_MAX_DURATION)
+    video_filter = build_video_filter(info, is_emoji)
+    # 8% headroom for container overhead
+    target_bitrate = int(VIDEO_STICKER_MAX_BYTES * 8 * 0.92 / duration)
+
+    fast_args = ("-crf", "32", "-b:v", str(target_bitrate), "-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1")
+    output = yield build_video_command(input_path, "pipe:1", video_filter, duration, fast_args)
+    if len(output) <= VIDEO_STICKER_MAX_BYTES:
+        return output
+
+    passlog_dir = tempfile.mkdtemp()
+    try:
+        passlog = os.path.join(passlog_dir, "pass")
+        bitrate = int(target_bitrate * min(0.9, VIDEO_STICKER_MAX_BYTES / len(output)))
+        for _ in range(2):
+            common = ("-b:v", str(bitrate), "-maxrate", str(bitrate), "-deadline", "good", "-cpu-used", "2", "-passlogfile", passlog)
+            yield build_video_command(input_path, "/dev/null", video_filter, duration, (*common, "-pass", "1"))
+            output = yield build_video_command(input_path, "pipe:1", video_filter, duration, (*common, "-pass", "2"))
+            if len(output) <= VIDEO_STICKER_MAX_BYTES:
+                return output
+            bitrate = int(bitrate * 0.75 * VIDEO_STICKER_MAX_BYTES / len(output))
+    finally:
+        shutil.rmtree(passlog_dir, ignore_errors=True)
+
+    raise Exception(f"Видео не влезает в {VIDEO_STICKER_MAX_BYTES // 1024} КБ даже после сжатия")
+
+ANIMATION_DEFAULT_FRAME_MS = 100
+WEBM_MAGIC = b"\x1a\x45\xdf\xa3"
+
+
+def is_webm(data: bytes | bytearray) -> bool:
+    return bytes(data[:4]) == WEBM_MAGIC
+
+
+def _gif_frame_count(data: bytes, stop: int = 2) -> int:
+    # Walks the block structure without decoding anything
+    view = memoryview(data)
+    if len(view) < 13:
+        return 0
+    pos = 13
+    if view[10] & 0x80:
+        pos += 3 << ((view[10] & 0x07) + 1)
+    frames = 0
+    while pos < len(view):
+        block = view[pos]
+        if block == 0x2C:
+            frames += 1
+            if frames >= stop or pos + 10 > len(view):
+                return frames
+            flags = view[pos + 9]
+            pos += 10
+            if flags & 0x80:
+                pos += 3 << ((flags & 0x07) + 1)
+            pos += 1
+        elif block == 0x21:
+            pos += 2
+        else:
+            return frames
+        while pos < len(view) and view[pos]:
+            pos += view[pos] + 1
+        pos += 1
+    return frames
+
+
+def is_animated_image(source: bytes | bytearray | str) -> bool:
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            head = f.read(6)
+            if head[:3] != b"GIF":
+                head += f.read(64 * 1024 - 6)
+            else:
+                head += f.read()
+    else:
+        head = source
+    if head[:3] == b"GIF":
+        return _gif_frame_count(head) > 1
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        # VP8X header with the animation flag set
+        return head[12:16] == b"VP8X" and len(head) > 20 and bool(head[20] & 0x02)
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        # APNG announces itself with an acTL chunk before the first IDAT
+        pos = 8
+        while pos + 8 <= len(head):
+            length = int.from_bytes(head[pos:pos + 4], "big")
+            chunk = bytes(head[pos + 4:pos + 8])
+            if chunk == b"acTL":
+                return int.from_bytes(head[pos + 8:pos + 12], "big") > 1
+            if chunk == b"IDAT":
+                return False
+            pos += length + 12
+    return False
+
+
+class Animation(NamedTuple):
+    width: int
+    height: int
+    fps: int
+    duration: float
+    # Distinct frames as raw RGBA and, for every output frame, which one to show
+    frames: list[bytes]
+    sequence: list[int]
+
+
+def decode_animation(source: BytesIO | str, is_emoji: bool = False) -> Animation:
+    from PIL import Image
+
+    grid = 1000 / VIDEO_STICKER_MAX_FPS
+    limit = VIDEO_STICKER_MAX_DURATION * 1000
+    frames, starts = [], []
+    shortest = None
+    elapsed = 0.0
+    with Image.open(source) as img:
+        box = 100 if is_emoji else 512
+        size = _fit_size(img.width, img.height, box)
+        canvas_size = (100, 100) if is_emoji else size
+        index = 0
+        while elapsed < limit:
+            try:
+                img.seek(index)
+            except EOFError:
+                break
+            index += 1
+            # WebP only fills in the frame's duration once it is loaded
+            img.load()
+            duration = img.info.get("duration") or 0
+            # Browsers play 0-10 ms GIF delays at 100 ms, and so do we
+            if duration <= 10:
+                duration = ANIMATION_DEFAULT_FRAME_MS
+            shortest = min(shortest or duration, duration)
+            start, elapsed = elapsed, elapsed + duration
+            # A frame that no 30 fps tick lands on can never be shown
+            if frames and math.ceil(start / grid) * grid >= elapsed:
+                continue
+            frame = img.convert("RGBA").resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+            if frame.size != canvas_size:
+                canvas = Image.new("RGBA", canvas_size, (0, 0, 0, 0))
+                canvas.paste(frame, ((canvas_size[0] - frame.width) // 2, (canvas_size[1] - frame.height) // 2))
+                frame = canvas
+            frames.append(frame.tobytes())
+            starts.append(start)
+
+    if not frames:
+        raise Exception("В анимации нет кадров")
+    duration = min(limit, elapsed)
+    fps = max(1, min(VIDEO_STICKER_MAX_FPS, round(1000 / shortest)))
+    count = max(1, min(int(duration * fps / 1000), int(VIDEO_STICKER_MAX_DURATION * fps)))
+    sequence = [bisect_right(starts, k * 1000 / fps) - 1 for k in range(count)]
+    return Animation(canvas_size[0], canvas_size[1], fps, count / fps, frames, sequence)
+
+
+def build_animation_command(animation: Animation, rate_args: tuple[str, ...]) -> list[str]:
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgba",
+        "-s", f"{animation.width}x{animation.height}",
+        "-framerate", str(animation.fps),
+        "-i", "pipe:0",
+        "-c:v", "libvpx-vp9",
+        "-pix_fmt", "yuva420p",
+        *rate_args,
+        "-an",
+        "-f", "webm",
+        "-y",
+        "pipe:1"
+    ]
+
+
+def _pipe_frames(command: list[str], animation: Animation, timeout: float | None) -> bytes:
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr)
+
+        def feed():
+            try:
+                for index in animation.sequence:
+                    process.stdin.write(animation.frames[index])
+            except (BrokenPipeError, ValueError):
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+
+        writer = threading.Thread(target=feed, daemon=True)
+        killer = threading.Timer(timeout, process.kill) if timeout else None
+        writer.start()
+        if killer:
+            killer.start()
+        try:
+            output = process.stdout.read()
+            process.wait()
+        finally:
+            if killer:
+                killer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            writer.join()
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise Exception(f"FFmpeg conversion failed: {stderr.read().decode(errors='replace').strip()}")
+    return output
+
+
+def process_animation(source: BytesIO | str, is_emoji: bool = False, timeout: float | None = None) -> bytes:
+    """Encodes a GIF, APNG or animated WebP as a video sticker.
+
+    Frames are decoded once, resampled to the sticker size and the frame rate
+    cap, and piped to ffmpeg as raw RGBA, so no intermediate file is written.
+    """
+    animation = decode_animation(source, is_emoji)
+    bitrate = int(VIDEO_STICKER_MAX_BYTES * 8 * 0.92 / animation.duration)
+    rate_args = ("-crf", "32", "-b:v", str(bitrate), "-deadline", "realtime", "-cpu-used", "8", "-row-mt", "1")
+    for _ in range(3):
+        output = _pipe_frames(build_animation_command(animation, rate_args), animation, timeout)
+        if len(output) <= VIDEO_STICKER_MAX_BYTES:
+            return output
+        # Same frames, slower encoder and a lower cap; decoding is never repeated
+        bitrate = int(bitrate * 0.85 * VIDEO_STICKER_MAX_BYTES / len(output))
+        rate_args = ("-b:v", str(bitrate), "-maxrate", str(bitrate), "-deadline", "good", "-cpu-used", "2")
+    raise Exception(f"Анимация не влезает в {VIDEO_STICKER_MAX_BYTES // 1024} КБ даже после сжатия")
+
+
+def needs_seekable_input(data: bytes) -> bool:
+    # MP4/MOV keep the index in the `moov` box; when it comes after `mdat`,
+    # ffmpeg has to seek to the end of the file and cannot read from a pipe
+    view = memoryview(data)
+    offset = 0
+    seen_mdat = False
+    while offset + 8 <= len(view):
+        size = int.from_bytes(view[offset:offset + 4], "big")
+        box_type = bytes(view[offset + 4:offset + 8])
+        if offset == 0 and box_type != b"ftyp":
+            return False
+        if box_type == b"moov":
+            return seen_mdat
+        if box_type == b"mdat":
+            seen_mdat = True
+        if size == 1 and offset + 16 <= len(view):
+            size = int.from_bytes(view[offset + 8:offset + 16], "big")
+        elif size == 0:
+            break
+        if size < 8:
+            break
+        offset += size
+    return seen_mdat
 
-    output_path = input_path + ".webm"
+def process_video(video_data: BytesIO, is_emoji: bool = False) -> BytesIO:
+    data = video_data.getvalue()
+    input_path = None
+    if needs_seekable_input(data):
+        with tempfile.NamedTemporaryFile(suffix=".mp4", delete=False) as temp_input:
+            temp_input.write(data)
+            input_path = temp_input.name
 
+    steps = video_sticker_steps(input_path or "pipe:0", is_emoji=is_emoji)
     try:
-        command = [
-            "ffmpeg",
-            "-i", input_path,
-            "-t", "3",
-            "-vf", "scale=512:512:force_original_aspect_ratio=decrease",
-            "-c:v", "libvpx-vp9",
-            "-b:v", "256k",
-            "-an",
-            "-f", "webm",
-            "-y",
-            output_path
-        ]
-        
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        with open(output_path, "rb") as f:
-            output_data = BytesIO(f.read())
-            
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"FFmpeg conversion failed: {e}")
+        command = next(steps)
+        while True:
+            result = subprocess.run(
+                command,
+                input=None if input_path else data,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            if result.returncode != 0:
+                raise Exception(f"FFmpeg conversion failed: {result.stderr.decode(errors='replace').strip()}")
+            command = steps.send(result.stdout)
+    except StopIteration as done:
+        return BytesIO(done.value)
     finally:
-        if os.path.exists(input_path):
+        steps.close()
+        if input_path and os.path.exists(input_path):
             os.remove(input_path)
-        if os.path.exists(output_path):
-            os.remove(output_path)
-            
-    return output_data
@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import tempfile
+
+from aiohttp import ClientError, ClientSession, UnixConnector, web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import (
+    MEDIA_JOB_TIMEOUT,
+    WEBHOOK_HOST,
+    WEBHOOK_PATH,
+    WEBHOOK_PORT,
+    WEBHOOK_SECRET,
+    WEBHOOK_URL,
+    WEBHOOK_WORKERS,
+)
+from loader import bot, dp
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    async def drain(self, timeout: float):
+        # Updates are handled in background tasks after Telegram already got
+        # its 200; wait for them before the bot session is closed
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logging.info(f"Waiting for {len(tasks)} in-flight updates...")
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logging.warning(f"Stopped with {len(pending)} updates still in flight")
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    handler = DrainingRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET)
+
+    async def drain_updates(_: web.Application):
+        await handler.drain(MEDIA_JOB_TIMEOUT)
+
+    # Registered first: aiohttp runs shutdown hooks in order, and the handler's
+    # own hook closes the bot session
+    app.on_shutdown.append(drain_updates)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def serve(sock: socket.socket):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+    logging.info(f"Webhook worker {dp.get('worker_index', 0)} listening on {sock.getsockname()}")
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+
+
+def update_user_id(update: dict) -> int:
+    # Album parts, FSM state, throttling and the menu cache all live in the
+    # process that handles the user, so all of a user's updates go to one worker
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user") or value.get("chat") or {}
+            if "id" in user:
+                return user["id"]
+    return update.get("update_id", 0)
+
+
+class UpdateRouter:
+    FORWARDED_HEADERS = ("Content-Type", "X-Telegram-Bot-Api-Secret-Token")
+
+    def __init__(self, paths: list[str]):
+        self.paths = paths
+        self.sessions: list[ClientSession] = []
+
+    async def start(self, _: web.Application):
+        self.sessions = [ClientSession(connector=UnixConnector(path=path)) for path in self.paths]
+
+    async def close(self, _: web.Application):
+        for session in self.sessions:
+            await session.close()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        session = self.sessions[update_user_id(update) % len(self.sessions)]
+        headers = {name: request.headers[name] for name in self.FORWARDED_HEADERS if name in request.headers}
+        try:
+            async with session.post(f"http://worker{WEBHOOK_PATH}", data=body, headers=headers) as response:
+                return web.Response(status=response.status, body=await response.read())
+        except ClientError as e:
+            # Telegram redelivers the update after a non-2xx answer
+            logging.error(f"Could not forward update to a worker: {e}")
+            return web.Response(status=502)
+
+
+async def route(sock: socket.socket, paths: list[str], workers: list):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    router = UpdateRouter(paths)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, router.handle)
+    app.on_startup.append(router.start)
+    app.on_cleanup.append(router.close)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.SockSite(runner, sock).start()
+    try:
+        await stop.wait()
+    finally:
+        # Stop taking updates first, then let every worker drain its own
+        await runner.cleanup()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            await asyncio.to_thread(worker.join)
+
+
+async def register_webhook():
+    if not WEBHOOK_URL:
+        logging.warning("WEBHOOK_URL is not set, leaving the Telegram webhook untouched")
+        return
+    await bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False,
+    )
+    await bot.session.close()
+
+
+def _worker(sock: socket.socket, index: int = 0):
+    dp["worker_index"] = index
+    asyncio.run(serve(sock))
+
+
+def run():
+    asyncio.run(register_webhook())
+    sock = socket.create_server((WEBHOOK_HOST, WEBHOOK_PORT), backlog=1024)
+    print(f"Starting webhook server with {WEBHOOK_WORKERS} worker(s)...")
+
+    if WEBHOOK_WORKERS <= 1:
+        _worker(sock)
+        return
+
+    # Telegram delivers album parts over parallel connections, so a shared
+    # listening socket would split one album between processes. The parent
+    # accepts every update and forwards it to the worker owning that user
+    directory = tempfile.mkdtemp(prefix="webhook-")
+    paths, worker_socks = [], []
+    for index in range(WEBHOOK_WORKERS):
+        path = os.path.join(directory, f"worker-{index}.sock")
+        worker_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        worker_sock.bind(path)
+        worker_sock.listen(1024)
+        paths.append(path)
+        worker_socks.append(worker_sock)
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=_worker, args=(worker_sock, index), daemon=False)
+        for index, worker_sock in enumerate(worker_socks)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker_sock in worker_socks:
+        worker_sock.close()
+
+    try:
+        asyncio.run(route(sock, paths, workers))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print("Bot stopped")
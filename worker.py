@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import signal
+
+from config import BOT_TOKEN, JOB_WORKER_CONCURRENCY, MEDIA_JOB_TIMEOUT
+from loader import bot, job_queue, media_engine, stats
+from database import db, init_db
+from handlers import run_sticker_job
+from jobqueue import JobWorker
+from main import warm_up
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main():
+    await init_db()
+    media_engine.start()
+    await warm_up()
+    stats.start()
+    worker = JobWorker(job_queue, {"stickers": run_sticker_job}, JOB_WORKER_CONCURRENCY)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, lambda: asyncio.create_task(worker.stop(timeout=MEDIA_JOB_TIMEOUT)))
+
+    print(f"Worker {worker.owner} started")
+    try:
+        await worker.run()
+        # stop() returns before run() notices, so wait for jobs still finishing
+        await worker.stop(timeout=MEDIA_JOB_TIMEOUT)
+    finally:
+        await media_engine.shutdown(drain_timeout=MEDIA_JOB_TIMEOUT)
+        await stats.stop()
+        await bot.session.close()
+        await db.close()
+
+
+if __name__ == "__main__":
+    if not BOT_TOKEN:
+        print("Error: BOT_TOKEN not found in .env file")
+    else:
+        asyncio.run(main())